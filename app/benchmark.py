@@ -0,0 +1,237 @@
+""" micro benchmarks for the serial verification hot paths.
+it uses synthetic data and a local SQLite database as the MySQL stand-in.
+
+run it from the app folder:
+    python benchmark.py run --ranges 100000 --prefixes 50 --out new.json
+    python benchmark.py compare old.json new.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from pandas import Series
+
+from import_db import find_collisions, insert_in_batches, normalize_column, normalize_string, separate
+from serial_index import Snapshot
+
+PERSIAN_DIGITS = '۰۱۲۳۴۵۶۷۸۹'
+ARABIC_DIGITS = '٠١٢٣٤٥٦٧٨٩'
+
+
+def make_prefixes(count, rnd):
+    """ count distinct two or three letter prefixes """
+    prefixes = set()
+    while len(prefixes) < count:
+        prefixes.add(''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(rnd.choice((2, 2, 3)))))
+    return sorted(prefixes)
+
+
+def make_ranges(count, prefixes, rnd, overlap=0.01):
+    """ serial rows like the serials table: (id, ref, description, start, end, date, text1, text2).
+    about `overlap` of the ranges collide with their neighbour """
+    rows = []
+    next_start = {prefix: rnd.randint(1, 1000) for prefix in prefixes}
+    for id_row in range(1, count + 1):
+        prefix = rnd.choice(prefixes)
+        start = next_start[prefix]
+        end = start + rnd.randint(0, 5000)
+        next_start[prefix] = end + 1 if rnd.random() > overlap else start + 1
+        rows.append((id_row, f'REF{id_row}', 'desc', normalize_string(f'{prefix}{start}'),
+                     normalize_string(f'{prefix}{end}'), datetime.datetime(2020, 1, 1), 'text1', 'text2'))
+    return rows
+
+
+def make_invalids(count, prefixes, rnd):
+    return [normalize_string(f'{rnd.choice(prefixes)}{rnd.randint(1, 10 ** 7)}') for _ in range(count)]
+
+
+def make_inputs(count, prefixes, rnd):
+    """ serials the way people type them in an sms: lower case, spaces, dashes,
+    Persian and Arabic digits """
+    inputs = []
+    for _ in range(count):
+        digits = str(rnd.randint(1, 10 ** 7))
+        style = rnd.random()
+        if style < 0.3:
+            digits = digits.translate(str.maketrans('0123456789', PERSIAN_DIGITS))
+        elif style < 0.5:
+            digits = digits.translate(str.maketrans('0123456789', ARABIC_DIGITS))
+        prefix = rnd.choice(prefixes)
+        if rnd.random() < 0.5:
+            prefix = prefix.lower()
+        inputs.append(rnd.choice(('{}{}', '{} {}', '{}-{}', ' {}{} ')).format(prefix, digits))
+    return inputs
+
+
+def _timed(function, repeat=3):
+    """ best wall time of `repeat` runs """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _latencies(function, arguments):
+    samples = []
+    for argument in arguments:
+        started = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {'p50_us': samples[len(samples) // 2] * 1e6,
+            'p99_us': samples[int(len(samples) * 0.99)] * 1e6,
+            'mean_us': statistics.fmean(samples) * 1e6}
+
+
+def bench_normalize(inputs):
+    elapsed = _timed(lambda: [normalize_string(serial) for serial in inputs])
+    column = Series(inputs, dtype=object)
+    column_elapsed = _timed(lambda: normalize_column(column))
+    return {'normalize_string_per_sec': len(inputs) / elapsed,
+            'normalize_column_per_sec': len(inputs) / column_elapsed}
+
+
+def _sqlite_tables(path):
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE serials (id INTEGER PRIMARY KEY, ref VARCHAR(200), description VARCHAR(200),
+                  start_serial CHAR(30), end_serial CHAR(30), date DATETIME, text1 TEXT, text2 TEXT)""")
+    db.execute("CREATE TABLE invalids (invalid_serial CHAR(30))")
+    return db
+
+
+def bench_import(rows, invalids, workdir):
+    db = _sqlite_tables(os.path.join(workdir, 'import.sqlite'))
+    errors = []
+    started = time.perf_counter()
+    inserted = insert_in_batches(db, db.cursor(), "INSERT INTO serials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 list(enumerate(rows, start=2)), 'serials', errors.append)
+    inserted += insert_in_batches(db, db.cursor(), "INSERT INTO invalids VALUES (?)",
+                                  [(line, (serial, )) for line, serial in enumerate(invalids, start=2)],
+                                  'invalids', errors.append)
+    elapsed = time.perf_counter() - started
+    db.execute("CREATE INDEX serials_range ON serials (start_serial, end_serial)")
+    db.execute("CREATE INDEX invalids_serial ON invalids (invalid_serial)")
+    db.commit()
+    return db, {'rows_per_sec': inserted / elapsed, 'errors': len(errors)}
+
+
+def bench_lookup(db, rows, invalids, queries):
+    snapshot = Snapshot(list(rows), invalids, 'benchmark')
+    normalized = [normalize_string(serial) for serial in queries]
+
+    def sql_lookup(serial):
+        cur = db.cursor()
+        cur.execute("SELECT * FROM invalids WHERE invalid_serial = ?", (serial, ))
+        if cur.fetchone():
+            return
+        cur.execute("SELECT * FROM serials WHERE start_serial <= ? and end_serial >= ?", (serial, serial))
+        cur.fetchmany(2)
+
+    build = _timed(lambda: Snapshot(list(rows), invalids), repeat=1)
+    return {'memory_index': _latencies(snapshot.lookup, normalized),
+            'memory_index_build_sec': build,
+            'sqlite_query': _latencies(sql_lookup, normalized[:2000])}
+
+
+def bench_db_check(rows, invalids):
+    def run():
+        data = {}
+        for id_row, _, _, start_serial, end_serial, *_ in rows:
+            letters, start = separate(start_serial)
+            data.setdefault(letters, []).append((id_row, start, separate(end_serial)[1]))
+        points = {}
+        for serial in invalids:
+            letters, digits = separate(serial)
+            points.setdefault(letters, set()).add(digits)
+        return sum(1 for letters in data for _ in find_collisions(data[letters], points.get(letters, ())))
+
+    elapsed = _timed(run, repeat=1)
+    return {'ranges_per_sec': len(rows) / elapsed, 'seconds': elapsed}
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    prefixes = make_prefixes(args.prefixes, rnd)
+    rows = make_ranges(args.ranges, prefixes, rnd)
+    invalids = make_invalids(args.invalids, prefixes, rnd)
+    inputs = make_inputs(args.lookups, prefixes, rnd)
+
+    results = {'meta': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'python': platform.python_version(),
+                        'ranges': args.ranges, 'prefixes': args.prefixes,
+                        'invalids': args.invalids, 'lookups': args.lookups, 'seed': args.seed}}
+    results['normalize'] = bench_normalize(inputs)
+    with tempfile.TemporaryDirectory() as workdir:
+        db, results['import'] = bench_import(rows, invalids, workdir)
+        results['lookup'] = bench_lookup(db, rows, invalids, inputs)
+        db.close()
+    results['db_check'] = bench_db_check(rows, invalids)
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as out:
+            out.write(text)
+    print(text)
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if key == 'meta':
+            continue
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(args):
+    """ prints every metric of two runs side by side. for *_per_sec higher is
+    better, for latencies and seconds lower is better """
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = _flatten(json.load(old_file)), _flatten(json.load(new_file))
+    print(f"{'metric':45} {'old':>14} {'new':>14} {'change':>9}")
+    for metric in sorted(set(old) | set(new)):
+        if metric not in old or metric not in new:
+            print(f'{metric:45} {old.get(metric, "-"):>14} {new.get(metric, "-"):>14}')
+            continue
+        change = (new[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0
+        better = change > 0 if metric.endswith('per_sec') else change < 0
+        mark = '' if abs(change) < 5 else (' +' if better else ' -')
+        print(f'{metric:45} {old[metric]:14.2f} {new[metric]:14.2f} {change:8.1f}%{mark}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='serial verification micro benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--ranges', type=int, default=20000)
+    run_parser.add_argument('--prefixes', type=int, default=20)
+    run_parser.add_argument('--invalids', type=int, default=2000)
+    run_parser.add_argument('--lookups', type=int, default=20000)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--out', help='save the results as json to this file')
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import threading
+import time
+
+import metrics
+
+
+# ER_SPECIFIC_ACCESS_DENIED_ERROR: SHOW REPLICA STATUS needs the REPLICATION CLIENT privilege
+PRIVILEGE_ERROR = 1227
+
+
+def _is_privilege_error(error):
+    return bool(error.args) and error.args[0] == PRIVILEGE_ERROR
+
+
+class PoolTimeout(Exception):
+    """ raised when no connection became free in time """
+
+
+class PooledConnection:
+    """ wraps a real MySQLdb connection. closing it gives the connection back
+    to the pool instead of closing the socket """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise AttributeError(f'connection is already returned to the pool; no {name}')
+        return getattr(conn, name)
+
+    def close(self):
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    """ a bounded pool of database connections.
+    at most `size` connections are open at the same time; callers wait up to
+    `timeout` seconds for a free one. connections which were idle for more
+    than `ping_after` seconds are pinged (and replaced if dead) before use """
+
+    def __init__(self, connect, size=10, timeout=10, ping_after=30):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._idle = []
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+
+    def _close_quietly(self, conn):
+        with self._cond:
+            self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _new(self):
+        with metrics.stage('db_connect'):
+            conn = self._connect()
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _healthy(self, conn, last_used):
+        if time.monotonic() - last_used < self.ping_after:
+            return conn
+        try:
+            with metrics.stage('db_ping'):
+                conn.ping()
+            return conn
+        except Exception:
+            self._close_quietly(conn)
+            return self._new()
+
+    def acquire(self):
+        """ checks out a connection. the caller has to close() it """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self.in_use < self.size:
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f'no free database connection after {self.timeout} seconds')
+                self.waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_use += 1
+
+        # connecting and pinging are slow, do them outside of the lock
+        try:
+            conn = self._new() if conn is None else self._healthy(conn, last_used)
+        except Exception:
+            with self._cond:
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn)
+
+    def release(self, pooled):
+        """ gives a connection back. it is safe to call this more than once """
+        conn = pooled.__dict__.get('_conn')
+        if conn is None:
+            return
+        pooled._conn = None
+        # end whatever transaction is open so the next user does not see an old snapshot
+        try:
+            conn.rollback()
+        except Exception:
+            self._close_quietly(conn)
+            conn = None
+        with self._cond:
+            self.in_use -= 1
+            if conn is not None:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size,
+                    'in_use': self.in_use,
+                    'idle': len(self._idle),
+                    'waiting': self.waiting,
+                    'created': self.created,
+                    'discarded': self.discarded,
+                    'timeouts': self.timeouts}
+
+
+class ReplicaRouter:
+    """ hands out connections for read-only queries.
+    `replicas` is a list of (name, ConnectionPool). a read goes to the next
+    replica (round robin) which is up and at most `max_lag` seconds behind the
+    primary; otherwise to `primary`. the lag of a replica is read from SHOW
+    REPLICA STATUS at most every `check_interval` seconds, on the connection
+    that is handed out anyway. if the user may not run it (no REPLICATION CLIENT
+    privilege) the lag is unknown: the replica is still used and a warning printed.
+    writes never come here; they use the primary pool """
+
+    def __init__(self, primary, replicas, max_lag=5, check_interval=5):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._state = {name: {'lag': None, 'lag_known': True, 'checked': 0, 'down_until': 0}
+                       for name, _ in self.replicas}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _lag(conn):
+        """ seconds behind the primary; 0 if the server is not a replica, None if
+        replication is stopped """
+        cur = conn.cursor()
+        try:
+            cur.execute('SHOW REPLICA STATUS')
+        except Exception as e:
+            if _is_privilege_error(e):
+                raise
+            cur.execute('SHOW SLAVE STATUS')  # before MySQL 8.0.22
+        row = cur.fetchone()
+        if row is None:
+            return 0
+        columns = [column[0] for column in cur.description]
+        for name in ('Seconds_Behind_Source', 'Seconds_Behind_Master'):
+            if name in columns:
+                return row[columns.index(name)]
+        return 0
+
+    def _order(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.replicas), 1)
+        return self.replicas[start:] + self.replicas[:start]
+
+    def _try(self, name, pool):
+        """ a connection of this replica or (None, why not) """
+        state = self._state[name]
+        now = time.monotonic()
+        if state['down_until'] > now:
+            return None, 'down'
+        if state['lag'] is not None and state['lag'] > self.max_lag and now - state['checked'] < self.check_interval:
+            return None, 'lag'
+        try:
+            conn = pool.acquire()
+        except Exception:
+            state['down_until'] = now + self.check_interval
+            return None, 'down'
+        if now - state['checked'] >= self.check_interval:
+            try:
+                lag = self._lag(conn)
+            except Exception as e:
+                if not _is_privilege_error(e):
+                    conn.close()
+                    state['down_until'] = now + self.check_interval
+                    return None, 'down'
+                if state['lag_known']:
+                    print(f'can not read the lag of replica {name}, it is used as if it was in sync; '
+                          f'grant the app user REPLICATION CLIENT. {e}')
+                state['lag'], state['lag_known'], state['checked'] = None, False, now
+                return conn, None
+            state['lag'], state['lag_known'], state['checked'] = (lag if lag is not None else float('inf')), True, now
+        if state['lag'] is not None and state['lag'] > self.max_lag:
+            conn.close()
+            return None, 'lag'
+        return conn, None
+
+    def acquire(self):
+        """ a connection for reads. the caller has to close() it """
+        reason = None
+        for name, pool in self._order():
+            conn, reason = self._try(name, pool)
+            if conn is not None:
+                metrics.count_route(name, 'read')
+                return conn
+        if self.replicas:
+            metrics.count_route('primary', f'fallback_{reason}')
+        else:
+            metrics.count_route('primary', 'read')
+        return self.primary.acquire()
+
+    def stats(self):
+        return {name: {'lag': self._state[name]['lag'],
+                       'lag_known': self._state[name]['lag_known'],
+                       'down': self._state[name]['down_until'] > time.monotonic(),
+                       'pool': pool.stats()}
+                for name, pool in self.replicas}
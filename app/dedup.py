@@ -0,0 +1,173 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+
+class LRUStore:
+    """ a bounded in-memory key/value store; entries expire after their ttl and
+    the least recently used ones are dropped when it is full """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _alive(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._alive(key, time.monotonic())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        """ sets the key only if it is not there. returns True if it was set """
+        with self._lock:
+            if self._alive(key, time.monotonic()):
+                return False
+            self._data[key] = (value, time.monotonic() + ttl)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisStore:
+    """ the same interface on a redis server, so all workers share what they saw.
+    needs the redis package; it is only imported when a url is configured """
+
+    def __init__(self, url, prefix='sms_dedup:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def add(self, key, value, ttl):
+        return bool(self._redis.set(self.prefix + key, json.dumps(value), ex=int(ttl), nx=True))
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+
+IN_FLIGHT = {'message': 'processing'}
+
+
+class CallbackDeduplicator:
+    """ remembers the webhook callbacks of the last `ttl` seconds.
+    a callback is identified by the gateway message id or, when there is none,
+    by sender + message within a `bucket` seconds window.
+
+        key, stored = dedup.claim(form)
+        if stored is not None:
+            return stored        # duplicate; answered before (or IN_FLIGHT, being answered)
+        ... process ...
+        dedup.done(key, response)
+    """
+
+    def __init__(self, max_entries=10000, ttl=600, bucket=60, shared_store=None):
+        self.ttl = ttl
+        self.bucket = bucket
+        self.local = LRUStore(max_entries)
+        self.shared = shared_store
+        self.counters = collections.Counter()
+
+    def keys(self, form):
+        """ all keys this callback may have been stored under; the first one is
+        where it gets stored. without a message id the previous time bucket is
+        checked too so a retry right after a bucket boundary is still caught """
+        message_id = form.get('messageid')
+        if message_id:
+            return [f'id:{message_id}']
+        digest = hashlib.sha1(f"{form.get('from')}\n{form.get('message')}".encode()).hexdigest()
+        bucket = int(time.time() // self.bucket)
+        return [f'msg:{digest}:{bucket}', f'msg:{digest}:{bucket - 1}']
+
+    def _lookup(self, key):
+        stored = self.local.get(key)
+        if stored is not None:
+            self.counters['local_hits'] += 1
+            return stored
+        if self.shared is not None:
+            try:
+                stored = self.shared.get(key)
+            except Exception:
+                self.counters['shared_errors'] += 1
+                return None
+            if stored is not None:
+                self.counters['shared_hits'] += 1
+                self.local.set(key, stored, self.ttl)
+        return stored
+
+    def claim(self, form):
+        """ returns (key, None) if this callback is new and has to be processed,
+        or (key, stored response) if it is a duplicate """
+        keys = self.keys(form)
+        for key in keys:
+            stored = self._lookup(key)
+            if stored is not None:
+                self.counters['duplicates'] += 1
+                return key, stored
+
+        key = keys[0]
+        if not self.local.add(key, IN_FLIGHT, self.ttl):
+            self.counters['duplicates'] += 1
+            return key, self.local.get(key) or IN_FLIGHT
+        if self.shared is not None:
+            try:
+                if not self.shared.add(key, IN_FLIGHT, self.ttl):
+                    self.counters['duplicates'] += 1
+                    self.counters['shared_hits'] += 1
+                    return key, self.shared.get(key) or IN_FLIGHT
+            except Exception:
+                self.counters['shared_errors'] += 1
+        self.counters['new'] += 1
+        return key, None
+
+    def done(self, key, response):
+        """ stores the response of a processed callback for its duplicates """
+        self.local.set(key, response, self.ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, response, self.ttl)
+            except Exception:
+                self.counters['shared_errors'] += 1
+
+    def forget(self, key):
+        """ processing failed; let the next retry try again """
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception:
+                self.counters['shared_errors'] += 1
+
+    def stats(self):
+        return {'entries': len(self.local), 'counters': dict(self.counters)}
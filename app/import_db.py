@@ -1,14 +1,92 @@
+import contextlib
 import datetime
+import heapq
+import importlib.util
+import json
 import os
 import time
 import sys
 import re
+import zipfile
 
 import config
 import MySQLdb
-from pandas import read_excel
+from openpyxl import load_workbook
+from pandas import DataFrame, Series, read_csv
 
 MAX_FLASH = 100
+DB_CHECK_CHUNK = 1000
+IMPORT_BATCH = 1000
+KEEP_GENERATIONS = 2
+IMPORT_LOCK_TIMEOUT = 3600
+SERIALS_NEW = 'serials_new'
+INVALIDS_NEW = 'invalids_new'
+NUMERALS_TABLE = str.maketrans('۱۲۳۴۵۶۷۸۹۰١٢٣٤٥٦٧٨٩٠', '12345678901234567890')
+SEPARATE_RE = re.compile(r'([A-Z]*)0*(\d*)')
+MAX_SERIAL_NUMBER = 2 ** 63 - 1  # BIGINT
+SERIAL_TABLES_RE = re.compile(r'serials(_new|_old\d+)?$')
+OVERLAPPING_LOG_NAME = 'overlapping_prefixes'
+# parquet and arrow files are read with pyarrow, which is imported only when one is
+HAVE_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+class ImportCancelled(Exception):
+    """ raised inside a running import when its job is cancelled """
+
+
+class ImportProgress:
+    """ live state of one import. the importer updates it, the web app reads it.
+    phases: queued, parse, insert, index, db_check, swap, done (or cancelled, failed).
+    listener, if set, is called with the progress after every phase change and batch """
+
+    def __init__(self):
+        self.phase = 'queued'
+        self.done = 0
+        self.total = None
+        self.read_share = None
+        self.started = None
+        self.phase_started = None
+        self.cancelled = False
+        self.listener = None
+
+    def start_phase(self, phase, total=None, read_share=None):
+        """ total is the number of rows of the phase, if known. if not, read_share can be
+        a function returning how much of the input has been read so far, from 0 to 1 """
+        self.check()
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        self.phase, self.done, self.total, self.phase_started = phase, 0, total, now
+        self.read_share = read_share
+        self._changed()
+
+    def advance(self, count):
+        self.done += count
+        self._changed()
+        self.check()
+
+    def check(self):
+        if self.cancelled:
+            raise ImportCancelled()
+
+    def _changed(self):
+        if self.listener is not None:
+            self.listener(self)
+
+    def as_dict(self):
+        elapsed = time.time() - self.phase_started if self.phase_started else 0
+        rate = self.done / elapsed if elapsed else 0
+        share = min(self.read_share(), 1.0) if self.read_share else None
+        if rate and self.total:
+            eta = (self.total - self.done) / rate
+        elif share:
+            eta = elapsed * (1 - share) / share
+        else:
+            eta = None
+        return {'phase': self.phase, 'done': self.done, 'total': self.total,
+                'read_percent': round(share * 100, 1) if share is not None else None,
+                'rows_per_sec': round(rate, 1), 'eta_seconds': round(eta, 1) if eta is not None else None,
+                'elapsed_seconds': round(time.time() - self.started, 1) if self.started else 0}
+
 
 def _remove_non_alphanum_char(string):
     return re.sub(r'\W+', '', string)
@@ -43,6 +121,292 @@ def normalize_string(serial_number, fixed_size=30):
 
 
 
+def normalize_column(column, fixed_size=30):
+    """ does what normalize_string does, but for a whole pandas column at once.
+    cells which are not text become None so the caller can report them """
+    is_text = column.map(lambda cell: isinstance(cell, str)).astype(bool)
+    # object, not str: the string dtype of newer pandas runs these through pyarrow,
+    # whose \W, \D and upper() differ from python's (persian digits, 'ß' -> 'SS')
+    text = column.where(is_text, '').astype(object)
+    text = text.str.replace(r'\W+', '', regex=True).str.upper().str.translate(NUMERALS_TABLE)
+    all_alpha = text.str.replace('[^A-Z]', '', regex=True)
+    all_digit = text.str.replace(r'\D', '', regex=True)
+    normalized = [alpha + digit.zfill(fixed_size - len(alpha))
+                  for alpha, digit in zip(all_alpha, all_digit)]
+    return Series(normalized, index=column.index, dtype=object).where(is_text, None)
+
+
+def _or_default(column, default):
+    """ replaces empty cells (NaN, '', 0) of a column with default """
+    return column.where(column.notna() & column.astype(bool), default)
+
+
+def insert_in_batches(db, cur, query, rows, sheet, report_error, progress=None):
+    """ gets (line number, values) rows and inserts IMPORT_BATCH of them with each
+    executemany. if a batch fails it is inserted again row by row, so every bad
+    line is still reported. returns the number of inserted rows """
+    inserted = 0
+    for i in range(0, len(rows), IMPORT_BATCH):
+        batch = rows[i:i + IMPORT_BATCH]
+        if progress is not None:
+            progress.advance(len(batch))
+        try:
+            cur.executemany(query, [values for _, values in batch])
+            db.commit()
+            inserted += len(batch)
+            continue
+        except Exception:
+            db.rollback()
+
+        for line_number, values in batch:
+            try:
+                cur.execute(query, values)
+                inserted += 1
+            except Exception as e:
+                report_error(f'Error inserting line {line_number} from {sheet}, {e}')
+        try:
+            db.commit()
+        except Exception as e:
+            report_error(f'Problem commiting {sheet} into db at around record {line_number} '
+                         f'(or previous {IMPORT_BATCH} ones); {e}')
+    return inserted
+
+
+def read_sheet_chunks(sheet, width, size=IMPORT_BATCH):
+    """ reads an openpyxl (read only) sheet lazily and yields DataFrames of up to
+    `size` rows: a 'line' column with the excel line number and `width` columns
+    numbered from 0. the header row and empty rows are skipped, so memory use
+    does not depend on the sheet size """
+    columns = list(range(width))
+    chunk = []
+    for line_number, values in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
+        values = (tuple(values) + (None, ) * width)[:width]
+        if all(value is None for value in values):
+            continue
+        chunk.append((line_number, ) + values)
+        if len(chunk) >= size:
+            yield DataFrame(chunk, columns=['line'] + columns, dtype=object)
+            chunk = []
+    if chunk:
+        yield DataFrame(chunk, columns=['line'] + columns, dtype=object)
+
+
+def file_type(path):
+    """ xlsx, csv, parquet or arrow, from the file name. only csv may be gzipped """
+    name = path.lower()
+    if name.endswith('.xlsx'):
+        return 'xlsx'
+    if name.endswith(('.csv', '.csv.gz')):
+        return 'csv'
+    if name.endswith('.parquet'):
+        return 'parquet'
+    if name.endswith(('.arrow', '.feather')):
+        return 'arrow'
+    raise ValueError(f'unknown file type: {path}')
+
+
+class _TrackedFile:
+    """ a file opened for reading in binary which remembers where its last read ended,
+    so how much of it has been read is known while pandas, gzip or zipfile read it """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.size = os.path.getsize(path)
+        self.position = 0
+
+    def _track(self, result):
+        self.position = self._file.tell()
+        return result
+
+    def read(self, size=-1):
+        return self._track(self._file.read(size))
+
+    def read1(self, size=-1):
+        return self._track(self._file.read1(size))
+
+    def readinto(self, buffer):
+        return self._track(self._file.readinto(buffer))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._track(next(self._file))
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+class _SheetsShare:
+    """ how much of the given sheets of an xlsx file has been read, from 0 to 1.
+    the sheets are zip members read one after the other, so the share follows
+    the position of the last read in the compressed data of the current one """
+
+    def __init__(self, file, spans):
+        self._file = file
+        self._spans = spans  # (offset, compressed size) of each sheet, in reading order
+        self._total = sum(size for _, size in spans)
+        self._share = 0.0
+
+    def __call__(self):
+        position, done = self._file.position, 0
+        for offset, size in self._spans:
+            # the member starts with its local header (30 bytes, the name and extra fields)
+            if offset <= position <= offset + size + 1024:
+                self._share = (done + min(position - offset, size)) / self._total if self._total else 1.0
+                break
+            done += size
+        return self._share
+
+
+def _arrow_batches(batches):
+    for batch in batches:
+        for offset in range(0, batch.num_rows, IMPORT_BATCH):
+            yield batch.slice(offset, IMPORT_BATCH).to_pandas()
+
+
+def table_rows(path):
+    """ the number of rows of a parquet or arrow file, from its metadata """
+    if file_type(path) == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    import pyarrow
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+    return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def read_table_chunks(path, width, file=None):
+    """ reads a csv, parquet or arrow file IMPORT_BATCH rows at a time and yields
+    DataFrames shaped like read_sheet_chunks() does. the first row of a csv is the
+    header. these go through pandas' C parser or pyarrow, not cell by cell python.
+    a csv is read from file instead, if it is given (path opened in binary) """
+    kind = file_type(path)
+    if kind == 'csv':
+        compression = 'gzip' if path.lower().endswith('.gz') else None
+        batches = read_csv(file or path, dtype=object, chunksize=IMPORT_BATCH, compression=compression)
+    elif kind == 'parquet':
+        import pyarrow.parquet
+        batches = _arrow_batches(pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=IMPORT_BATCH))
+    elif kind == 'arrow':
+        import pyarrow
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        batches = _arrow_batches(reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        raise ValueError(f'{path} is not a csv, parquet or arrow file')
+
+    line_number = 2
+    for df in batches:
+        df = df.iloc[:, :width].astype(object)
+        df.columns = list(range(df.shape[1]))
+        for column in range(df.shape[1], width):
+            df[column] = None
+        df.insert(0, 'line', range(line_number, line_number + len(df)))
+        line_number += len(df)
+        yield df
+
+
+@contextlib.contextmanager
+def open_catalog(filepath, invalids_path=None):
+    """ opens an uploaded catalog and yields
+    (file type, number of rows, share read, serial chunks, invalid chunks).
+    an xlsx file has both sheets; other types need the invalids in their own file.
+    parquet and arrow files know their number of rows. csv and xlsx ones do not (the
+    dimension a read-only sheet reports is often the whole formatted area, A1:F1048576),
+    so for them it is None and share read is a function returning how much of the
+    files (of the two sheets, for xlsx) has been read so far; the time left is
+    estimated from that """
+    kind = file_type(filepath)
+    if kind != 'xlsx':
+        if not invalids_path:
+            raise ValueError(f'a {kind} catalog needs a second file with the invalid serials')
+        if kind != 'csv':
+            yield (kind, table_rows(filepath) + table_rows(invalids_path), None,
+                   read_table_chunks(filepath, 8), read_table_chunks(invalids_path, 1))
+            return
+        with _TrackedFile(filepath) as serial_file, _TrackedFile(invalids_path) as invalid_file:
+            size = serial_file.size + invalid_file.size
+
+            def share():
+                return (serial_file.position + invalid_file.position) / size if size else 1.0
+
+            yield (kind, None, share,
+                   read_table_chunks(filepath, 8, serial_file), read_table_chunks(invalids_path, 1, invalid_file))
+        return
+
+    # one pass over the file; each sheet is read lazily, IMPORT_BATCH rows at a time
+    with _TrackedFile(filepath) as file:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            serial_sheet, invalid_sheet = workbook.worksheets[0], workbook.worksheets[1]
+            with zipfile.ZipFile(filepath) as archive:
+                spans = [(info.header_offset, info.compress_size)
+                         for info in (archive.getinfo(sheet._worksheet_path) for sheet in (serial_sheet, invalid_sheet))]
+            yield (kind, None, _SheetsShare(file, spans),
+                   read_sheet_chunks(serial_sheet, 8), read_sheet_chunks(invalid_sheet, 1))
+        finally:
+            workbook.close()
+
+
+def _timed_chunks(chunks, spent):
+    """ passes the chunks through and adds the time spent reading them to spent[0] """
+    chunks = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        try:
+            df = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            spent[0] += time.perf_counter() - started
+        yield df
+
+
+def serial_numbers(start_serial, end_serial):
+    """ gets the normalized start and end serial of a range and returns
+    (prefix, start number, end number) for the numeric lookup columns.
+    all three are None if the letters differ or a number does not fit a BIGINT """
+    start_alpha, start_number = separate(start_serial)
+    end_alpha, end_number = separate(end_serial)
+    if start_alpha != end_alpha or max(start_number, end_number) > MAX_SERIAL_NUMBER:
+        return None, None, None
+    return start_alpha, start_number, end_number
+
+
+def serial_rows(df, report_error):
+    """ gets a chunk of the serials sheet and returns (line number, values) rows ready
+    to be inserted; rows without text serials are reported and skipped """
+    start_serials = normalize_column(df[3])
+    end_serials = normalize_column(df[4])
+    columns = (df[0], _or_default(df[1], ""), _or_default(df[2], ""), start_serials, end_serials,
+               _or_default(df[5], "7/2/12"), df[6].where(df[6].notna(), ""), df[7].where(df[7].notna(), ""))
+    rows = []
+    for line_number, values in zip(df['line'], zip(*columns)):
+        if values[3] is None or values[4] is None:
+            report_error(f'Error inserting line {line_number} from serials sheet SERIALS, '
+                         f'serial is not a text')
+            continue
+        rows.append((line_number, values + serial_numbers(values[3], values[4])))
+    return rows
+
+
+def invalid_rows(df, report_error):
+    """ same as serial_rows() for a chunk of the invalids sheet """
+    rows = []
+    for line_number, failed_serial in zip(df['line'], normalize_column(df[0])):
+        if failed_serial is None:
+            report_error(f'Error inserting line {line_number} from invalids sheet INVALIDS, '
+                         f'serial is not a text')
+            continue
+        rows.append((line_number, (failed_serial, )))
+    return rows
+
+
 def get_database_connection():
     """connects to the MySQL database and returns the connection"""
     return MySQLdb.connect(host=config.MYSQL_HOST,
@@ -51,17 +415,29 @@ def get_database_connection():
                            db=config.MYSQL_DB_NAME,
                            charset='utf8')
 
-def import_database_from_excel(filepath):
+def create_logs_table(cur):
+    """ the logs of the last import and db check, the data generation and other shared state """
+    cur.execute("""CREATE TABLE IF NOT EXISTS logs (
+        log_name CHAR(200),
+        log_value MEDIUMTEXT);
+        """)
+
+
+def import_database_from_file(filepath, progress=None, invalids_path=None):
     """ gets an excel file name and imports lookup data (data and failures) from it
     the first (0) sheet contains serial data like:
      Row	Reference Number	Description	Start Serial	End Serial	Date
     and the 2nd (1) contains a column of invalid serials. 
+    csv (.csv or .csv.gz), parquet and arrow (.arrow/.feather) files are read
+    the same way; they hold one table each, so the invalids come in invalids_path
 
-    This data will be written into the sqlite database located at config.DATABASE_FILE_PATH
-    in two tables. "serials" and "invalids"
+    This data will be written into the MySQL database in two shadow tables,
+    "serials_new" and "invalids_new". see swap_in_new_tables()
 
     returns two integers: (number of serial rows, number of invalid rows)
+    progress (an ImportProgress) is updated on the way; cancelling it stops the import
     """
+    progress = progress or ImportProgress()
     # df contains lookup data in the form of
     # Row	Reference Number	Description	Start Serial	End Serial	Date
 
@@ -72,23 +448,22 @@ def import_database_from_excel(filepath):
     total_flashes = 0
     output = []
 
+    # logs are kept between imports (the current generation lives there);
+    # only this import's entries are replaced
     try:
-        cur.execute('DROP TABLE IF EXISTS logs;')
-        cur.execute("""CREATE TABLE logs (            
-            log_name CHAR(200),
-            log_value MEDIUMTEXT);
-            """)
+        create_logs_table(cur)
+        cur.execute("DELETE FROM logs WHERE log_name IN ('db_filename', 'import', 'db_check')")
         db.commit()
     except Exception as e:
-        print("dropping logs")
+        print("problem preparing logs")
         output.append(
-            f'problem dropping and creating new table for logs in database; {e}')
-
+            f'problem preparing the logs table in database; {e}')
 
-    # remove the serials table if exists, then create the new one
+    # the new data goes into shadow tables; lookups keep using the current
+    # ones until swap_in_new_tables() renames them
     try:
-        cur.execute('DROP TABLE IF EXISTS serials;')
-        cur.execute("""CREATE TABLE serials (
+        cur.execute(f'DROP TABLE IF EXISTS {SERIALS_NEW};')
+        cur.execute(f"""CREATE TABLE {SERIALS_NEW} (
             id INTEGER PRIMARY KEY,
             ref VARCHAR(200),
             description VARCHAR(200),
@@ -96,24 +471,26 @@ def import_database_from_excel(filepath):
             end_serial CHAR(30),
             date DATETIME,
             text1 TEXT,
-            text2 TEXT, INDEX(start_serial, end_serial));""")
+            text2 TEXT,
+            prefix VARCHAR(30),
+            start_number BIGINT,
+            end_number BIGINT);""")
         db.commit()
     except Exception as e:
-        print("problem dropping serials")
+        print("problem creating serials")
         output.append(
-            f'problem dropping and creating new table serials in database; {e}')
-    
+            f'problem dropping and creating new table {SERIALS_NEW} in database; {e}')
+
     cur.execute("INSERT INTO logs VALUES ('db_filename', %s)", (filepath, ))
     db.commit()
 
-    # remove the invalid table if exists, then create the new one
     try:
-        cur.execute('DROP TABLE IF EXISTS invalids;')
-        cur.execute("""CREATE TABLE invalids (
-            invalid_serial CHAR(30), INDEX(invalid_serial));""")
+        cur.execute(f'DROP TABLE IF EXISTS {INVALIDS_NEW};')
+        cur.execute(f"""CREATE TABLE {INVALIDS_NEW} (
+            invalid_serial CHAR(30));""")
         db.commit()
     except Exception as e:
-        output.append(f'Error dropping and creating INVALIDS table; {e}')
+        output.append(f'Error dropping and creating {INVALIDS_NEW} table; {e}')
 
     # insert some place holder logs
     cur.execute("INSERT INTO logs VALUES ('import', %s)",
@@ -121,153 +498,418 @@ def import_database_from_excel(filepath):
     cur.execute("INSERT INTO logs VALUES ('db_check', %s)", ('DB check will be run after the insert is finished', ))
     db.commit()
 
-    df = read_excel(filepath, 0)
-    serials_counter = 1
-    line_number = 1
-
-    for _, (line, ref, description, start_serial, end_serial, date, text1, text2) in df.iterrows():
-        line_number += 1
-        if not ref or (ref != ref):
-            ref = ""
-        if not description or (description != description):
-            description = ""
-        if not date or (date != date):
-            date = "7/2/12"
-        try:
-            start_serial = normalize_string(start_serial)
-            end_serial = normalize_string(end_serial)
-            cur.execute("INSERT INTO serials VALUES (%s, %s, %s, %s, %s, %s, %s, %s);", (
-                line, ref, description, start_serial, end_serial, date, text1, text2)
-            )
-            serials_counter += 1
-        except Exception as e:
-            total_flashes += 1
-            if total_flashes < MAX_FLASH:                
-                output.append(
-                    f'Error inserting line {line_number} from serials sheet SERIALS, {e}')
-            elif total_flashes == MAX_FLASH:
-                output.append(f'Too many errors!')
-        if line_number % 1000 == 0:
-            try:
-                db.commit()
-            except Exception as e:
-                output.append(
-                    f'Problem commiting serials into db at around record {line_number} (or previous 1000 ones); {e}')
-    db.commit()
-
-    # now lets save the invalid serials.
-
-    invalid_counter = 1
-    line_number = 1
-    df = read_excel(filepath, 1)
-    for _, (failed_serial,) in df.iterrows():
-        line_number += 1
-        try:
-            failed_serial = normalize_string(failed_serial)
-            cur.execute('INSERT INTO invalids VALUES (%s);', (failed_serial,))
-            invalid_counter += 1
-        except Exception as e:
-            total_flashes += 1
-            if total_flashes < MAX_FLASH:
-                output.append(
-                    f'Error inserting line {line_number} from serials sheet SERIALS, {e}')
-            elif total_flashes == MAX_FLASH:
-                output.append(f'Too many errors!')
-
-        if line_number % 1000 == 0:
-            try:
-                db.commit()
-            except Exception as e:
-                output.append(
-                    f'Problem commiting invalid serials into db at around record {line_number} (or previous 1000 ones); {e}')
-    db.commit()
+    def report_error(message):
+        nonlocal total_flashes
+        total_flashes += 1
+        if total_flashes < MAX_FLASH:
+            output.append(message)
+        elif total_flashes == MAX_FLASH:
+            output.append(f'Too many errors!')
+
+    started = time.time()
+    progress.start_phase('parse')
+
+    parse_time = [0.0]
+    with open_catalog(filepath, invalids_path) as (file_type, total, read_share, serial_chunks, invalid_chunks):
+        progress.start_phase('insert', total, read_share)
+
+        serials_counter = 0
+        for df in _timed_chunks(serial_chunks, parse_time):
+            rows = serial_rows(df, report_error)
+            serials_counter += insert_in_batches(
+                db, cur, f"INSERT INTO {SERIALS_NEW} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                rows, 'serials sheet SERIALS', report_error, progress)
+
+        # now lets save the invalid serials.
+        invalid_counter = 0
+        for df in _timed_chunks(invalid_chunks, parse_time):
+            rows = invalid_rows(df, report_error)
+            invalid_counter += insert_in_batches(db, cur, f"INSERT INTO {INVALIDS_NEW} VALUES (%s)",
+                                                 rows, 'invalids sheet INVALIDS', report_error, progress)
+
+    parsed = serials_counter + invalid_counter
+    parse_rate = parsed / parse_time[0] if parse_time[0] else 0
+    output.append(f'Read {file_type} in {parse_time[0]:.1f} seconds ({parse_rate:.0f} rows/sec)')
+
+    elapsed = time.time() - started
+    rate = (serials_counter + invalid_counter) / elapsed if elapsed else 0
+
+    # indexes are built once after loading, which is faster than keeping them up to date per insert
+    progress.start_phase('index')
+    try:
+        # lookups are an equality on the prefix and a range on start_number
+        cur.execute(f"ALTER TABLE {SERIALS_NEW} ADD INDEX serial_lookup (prefix, start_number, end_number)")
+        cur.execute(f"ALTER TABLE {INVALIDS_NEW} ADD INDEX(invalid_serial)")
+        db.commit()
+    except Exception as e:
+        output.append(f'Error indexing the new tables; {e}')
 
     # save the logs
-    output.append(f'Inserted {serials_counter} serials and {invalid_counter} invalids')
+    output.append(f'Inserted {serials_counter} serials and {invalid_counter} invalids '
+                  f'in {elapsed:.1f} seconds ({rate:.0f} rows/sec)')
     output.reverse()
     cur.execute("UPDATE logs SET log_value = %s WHERE log_name = 'import'", ('\n'.join(output), ))
     db.commit()
 
     db.close()
 
-    return
+    return serials_counter, invalid_counter
+
+
+def separate(input_string):
+    """ gets AA0000000000000000000000000090 and returns AA, 90 """
+    alpha_part, digit_part = SEPARATE_RE.match(input_string).groups()
+    return alpha_part, int(digit_part or 0)
+
+
+def find_collisions(ranges, invalids=()):
+    """ gets (id, start, end) ranges and invalid serial numbers of one letter prefix.
+    sorts everything once and sweeps over it, keeping the ranges which are still
+    open in a heap ordered by their end. yields
+      ('collision', id1, id2) for every pair of overlapping ranges and
+      ('invalid', serial, id) for every invalid serial inside a range
+    in O(n log n + number of problems) """
+    # at the same position a range has to open before a point is checked
+    events = [(start, 0, end, id_row) for id_row, start, end in ranges]
+    events.extend((serial, 1, serial, None) for serial in invalids)
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    active = []
+    for position, kind, end, id_row in events:
+        while active and active[0][0] < position:
+            heapq.heappop(active)
+        if kind == 0:
+            for _, other_id in active:
+                yield 'collision', other_id, id_row
+            heapq.heappush(active, (end, id_row))
+        else:
+            for _, other_id in active:
+                yield 'invalid', position, other_id
 
 
-def db_check():
-    """ will do some sanity checks on the db and will flash the errors """
+def db_check(serials_table='serials', invalids_table='invalids', progress=None, prefixes=None):
+    """ will do some sanity checks on the db and will flash the errors
+    problems are written into the db_check log in chunks, while they are found.
+    with `prefixes` only the ranges of those letter prefixes are checked.
+    returns the checked letter prefixes which have overlapping ranges """
+    progress = progress or ImportProgress()
 
     db = get_database_connection()
     cur = db.cursor()
+    cur.execute("DELETE FROM logs WHERE log_name = 'db_check'")
     cur.execute("INSERT INTO logs VALUES ('db_check', %s)",
                 ('DB check started... wait for the results. it may take a while', ))
     db.commit()
 
-    def collision(s1, e1, s2, e2):
-        if s2 <= s1 <= e2:
-            return True
-        if s2 <= e1 <= e2:
-            return True
-        if s1 <= s2 <= e1:
-            return True
-        if s1 <= e2 <= e1:
-            return True
-        return False
-
-    def separate(input_string):
-        """ gets AA0000000000000000000000000090 and returns AA, 90 """
-        digit_part = ''
-        alpha_part = ''
-        for character in input_string:
-            if character.isalpha():
-                alpha_part += character
-            elif character.isdigit():
-                digit_part += character
-        return alpha_part, int(digit_part)
-
-
-
-    cur.execute("SELECT id, start_serial, end_serial FROM serials")
-
-    raw_data = cur.fetchall()
-    all_problems = []
+    pending = []
+    written = [0]
+    # lines about the check itself go first and are not counted as problems
+    notes = []
+    if prefixes is not None:
+        notes.append(f'checking only the changed prefixes: {", ".join(sorted(prefixes)) or "none"}')
+
+    def report(problem):
+        pending.append(problem)
+        if len(pending) >= DB_CHECK_CHUNK:
+            flush()
+
+    def flush():
+        if not pending:
+            return
+        chunk = '\n'.join(pending) + '\n'
+        if written[0]:
+            cur.execute("UPDATE logs SET log_value = CONCAT(log_value, %s) WHERE log_name = 'db_check'",
+                        (chunk, ))
+        else:
+            cur.execute("UPDATE logs SET log_value = %s WHERE log_name = 'db_check'",
+                        (''.join(note + '\n' for note in notes) + chunk, ))
+        db.commit()
+        written[0] += len(pending)
+        pending.clear()
 
     data = {}
-    flashed = 0
-    for row in raw_data:
-        id_row, start_serial, end_serial = row
+    cur.execute(f"SELECT id, start_serial, end_serial FROM {serials_table}")
+    for id_row, start_serial, end_serial in cur.fetchall():
         start_serial_alpha, start_serial_digit = separate(start_serial)
         end_serial_alpha, end_serial_digit = separate(end_serial)
+        if prefixes is not None and start_serial_alpha not in prefixes and end_serial_alpha not in prefixes:
+            continue
         if start_serial_alpha != end_serial_alpha:
-            all_problems.append(
-                f'start serial and end serial of row {id_row} start with different letters')
+            report(f'start serial and end serial of row {id_row} start with different letters')
         else:
-            if start_serial_alpha not in data:
-                data[start_serial_alpha] = []
-            data[start_serial_alpha].append(
+            data.setdefault(start_serial_alpha, []).append(
                 (id_row, start_serial_digit, end_serial_digit))
 
-    flashed = 0
+    invalids = {}
+    cur.execute(f"SELECT invalid_serial FROM {invalids_table}")
+    for (invalid_serial, ) in cur.fetchall():
+        letters, digits = separate(invalid_serial)
+        if letters in data:
+            invalids.setdefault(letters, set()).add(digits)
+
+    overlapping = set()
+    progress.start_phase('db_check', sum(len(ranges) for ranges in data.values()))
     for letters in data:
-        for i in range(len(data[letters])):
-            for j in range(i+1, len(data[letters])):
-                id_row1, ss1, es1 = data[letters][i]
-                id_row2, ss2, es2 = data[letters][j]
-                if collision(ss1, es1, ss2, es2):
-                    all_problems.append(
-                        f'there is a collision between row ids {id_row1} and {id_row2}')
-    
-    all_problems.reverse()
-    output = "\n".join(all_problems)
-    
-    cur.execute("UPDATE logs SET log_value = %s WHERE log_name = 'db_check'", (output, ))
+        progress.advance(len(data[letters]))
+        for problem in find_collisions(data[letters], invalids.get(letters, ())):
+            if problem[0] == 'collision':
+                overlapping.add(letters)
+                report(f'there is a collision between row ids {problem[1]} and {problem[2]}')
+            else:
+                report(f'invalid serial {letters}{problem[1]} is inside the range of row id {problem[2]}')
+
+    total = written[0] + len(pending)
+    pending.append(f'DB check finished; {total} problems found')
+    flush()
+
+    db.close()
+    return overlapping
+
+
+def publish_generation(overlapping=None, checked=None):
+    """ marks the end of this import. running web servers see the new
+    generation in the logs table and reload their in-memory serial index.
+    `overlapping` are the letter prefixes db_check found overlapping ranges in;
+    the db lookups (serial_index.DbSerialLookup) need it to take their fast path.
+    with `checked` only those prefixes were checked and the rest of the last
+    published set is kept. None means unknown, e.g. after a rollback """
+
+    db = get_database_connection()
+    cur = db.cursor()
+    if overlapping is not None and checked is not None:
+        cur.execute("SELECT log_value FROM logs WHERE log_name = %s", (OVERLAPPING_LOG_NAME, ))
+        row = cur.fetchone()
+        if row is None:
+            overlapping = None
+        else:
+            overlapping = (set(json.loads(row[0])) - set(checked)) | set(overlapping)
+    generation = str(time.time_ns())
+    cur.execute("DELETE FROM logs WHERE log_name IN ('generation', %s)", (OVERLAPPING_LOG_NAME, ))
+    cur.execute("INSERT INTO logs VALUES ('generation', %s)", (generation, ))
+    if overlapping is not None:
+        cur.execute("INSERT INTO logs VALUES (%s, %s)", (OVERLAPPING_LOG_NAME, json.dumps(sorted(overlapping))))
+    db.commit()
+    db.close()
+
+
+def _existing_tables(cur):
+    cur.execute("SHOW TABLES")
+    return {row[0] for row in cur.fetchall()}
+
+
+def swap_in_new_tables():
+    """ replaces serials and invalids with the shadow tables in one atomic
+    RENAME TABLE. the replaced tables are kept as serials_old1, serials_old2, ...
+    (up to KEEP_GENERATIONS) so rollback() can bring them back """
+
+    db = get_database_connection()
+    cur = db.cursor()
+    tables = _existing_tables(cur)
+
+    renames = []
+    for table in ('serials', 'invalids'):
+        oldest = f'{table}_old{KEEP_GENERATIONS}'
+        if oldest in tables:
+            cur.execute(f'DROP TABLE {oldest}')
+        for generation in range(KEEP_GENERATIONS - 1, 0, -1):
+            if f'{table}_old{generation}' in tables:
+                renames.append(f'{table}_old{generation} TO {table}_old{generation + 1}')
+        if table in tables:
+            renames.append(f'{table} TO {table}_old1')
+        renames.append(f'{table}_new TO {table}')
+
+    cur.execute('RENAME TABLE ' + ', '.join(renames))
+    db.commit()
+    db.close()
+
+
+def rollback():
+    """ swaps the current serials and invalids with the previous generation
+    (serials_old1, invalids_old1). calling it again rolls forward """
+
+    db = get_database_connection()
+    cur = db.cursor()
+    tables = _existing_tables(cur)
+    if not {'serials_old1', 'invalids_old1'} <= tables:
+        print('there is no old generation to roll back to')
+        db.close()
+        return False
+    cur.execute("""RENAME TABLE serials TO serials_swap, serials_old1 TO serials, serials_swap TO serials_old1,
+                   invalids TO invalids_swap, invalids_old1 TO invalids, invalids_swap TO invalids_old1""")
+    db.commit()
+    db.close()
+    return True
+
+
+SERIAL_CHANGED = """NOT (n.ref <=> s.ref AND n.description <=> s.description
+    AND n.start_serial <=> s.start_serial AND n.end_serial <=> s.end_serial
+    AND n.date <=> s.date AND n.text1 <=> s.text1 AND n.text2 <=> s.text2)"""
+
+
+def apply_delta(progress=None):
+    """ applies the difference between the shadow tables and the live ones to
+    the live tables instead of swapping them: serials are matched by id and
+    invalids by their normalized serial. inserts, updates and deletes are one
+    transaction, so lookups see either the old or the new data.
+    returns the change counts and the letter prefixes which were touched """
+    progress = progress or ImportProgress()
+    progress.start_phase('delta')
+
+    db = get_database_connection()
+    cur = db.cursor()
+
+    # the prefixes of both the old and the new version of every changed row
+    prefixes = set()
+    cur.execute(f"""SELECT n.start_serial, n.end_serial FROM {SERIALS_NEW} n
+                    LEFT JOIN serials s ON s.id = n.id WHERE s.id IS NULL OR {SERIAL_CHANGED}""")
+    touched = cur.fetchall()
+    cur.execute(f"""SELECT s.start_serial, s.end_serial FROM serials s
+                    LEFT JOIN {SERIALS_NEW} n ON n.id = s.id WHERE n.id IS NULL OR {SERIAL_CHANGED}""")
+    touched += cur.fetchall()
+    cur.execute(f"""SELECT n.invalid_serial FROM {INVALIDS_NEW} n
+                    LEFT JOIN invalids i ON i.invalid_serial = n.invalid_serial WHERE i.invalid_serial IS NULL""")
+    touched += cur.fetchall()
+    cur.execute(f"""SELECT i.invalid_serial FROM invalids i
+                    LEFT JOIN {INVALIDS_NEW} n ON n.invalid_serial = i.invalid_serial WHERE n.invalid_serial IS NULL""")
+    touched += cur.fetchall()
+    for row in touched:
+        for serial in row:
+            prefixes.add(separate(serial)[0])
+    progress.check()
+
+    counts = {}
+    try:
+        cur.execute(f"""DELETE s FROM serials s LEFT JOIN {SERIALS_NEW} n ON n.id = s.id
+                        WHERE n.id IS NULL""")
+        counts['deleted'] = cur.rowcount
+        cur.execute(f"""UPDATE serials s JOIN {SERIALS_NEW} n ON n.id = s.id
+                        SET s.ref = n.ref, s.description = n.description, s.start_serial = n.start_serial,
+                            s.end_serial = n.end_serial, s.date = n.date, s.text1 = n.text1, s.text2 = n.text2,
+                            s.prefix = n.prefix, s.start_number = n.start_number, s.end_number = n.end_number
+                        WHERE {SERIAL_CHANGED}""")
+        counts['updated'] = cur.rowcount
+        cur.execute(f"""INSERT INTO serials SELECT n.* FROM {SERIALS_NEW} n
+                        LEFT JOIN serials s ON s.id = n.id WHERE s.id IS NULL""")
+        counts['inserted'] = cur.rowcount
+        cur.execute(f"""DELETE i FROM invalids i LEFT JOIN {INVALIDS_NEW} n ON n.invalid_serial = i.invalid_serial
+                        WHERE n.invalid_serial IS NULL""")
+        counts['invalids_removed'] = cur.rowcount
+        cur.execute(f"""INSERT INTO invalids SELECT DISTINCT n.invalid_serial FROM {INVALIDS_NEW} n
+                        LEFT JOIN invalids i ON i.invalid_serial = n.invalid_serial WHERE i.invalid_serial IS NULL""")
+        counts['invalids_added'] = cur.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        db.close()
+        raise
+
+    cur.execute(f'DROP TABLE IF EXISTS {SERIALS_NEW}, {INVALIDS_NEW}')
     db.commit()
+    db.close()
+    return counts, prefixes
+
+
+def migrate_serial_numbers():
+    """ adds the prefix, start_number and end_number columns (and their index) to
+    serials tables created before they existed, including the old generations,
+    and fills them in from start_serial and end_serial """
 
+    db = get_database_connection()
+    cur = db.cursor()
+    for table in sorted(_existing_tables(cur)):
+        if not SERIAL_TABLES_RE.match(table):
+            continue
+        cur.execute(f"SHOW COLUMNS FROM {table} LIKE 'start_number'")
+        if cur.fetchone():
+            continue
+        print(f'adding the numeric serial columns to {table}')
+        cur.execute(f"""ALTER TABLE {table}
+                        ADD COLUMN prefix VARCHAR(30), ADD COLUMN start_number BIGINT, ADD COLUMN end_number BIGINT,
+                        ADD INDEX serial_lookup (prefix, start_number, end_number)""")
+        cur.execute(f"SELECT id, start_serial, end_serial FROM {table}")
+        rows = [serial_numbers(start_serial, end_serial) + (id_row, )
+                for id_row, start_serial, end_serial in cur.fetchall()
+                if start_serial is not None and end_serial is not None]
+        for i in range(0, len(rows), IMPORT_BATCH):
+            cur.executemany(f"UPDATE {table} SET prefix = %s, start_number = %s, end_number = %s WHERE id = %s",
+                            rows[i:i + IMPORT_BATCH])
+            db.commit()
     db.close()
 
 
-filepath = sys.argv[1]
+def _append_import_log(message):
+    db = get_database_connection()
+    cur = db.cursor()
+    cur.execute("UPDATE logs SET log_value = CONCAT(%s, log_value) WHERE log_name = 'import'", (message + '\n', ))
+    db.commit()
+    db.close()
 
-import_database_from_excel(filepath)
-db_check()
 
-os.remove(filepath)
+def run_import(filepath, progress=None, invalids_path=None, delta=False):
+    """ the whole import: loads the file into the shadow tables, checks them and
+    swaps them in. with `delta` only the differences are applied to the live tables
+    and only the changed prefixes are checked; the file still has to be the whole catalog.
+    only one import runs at a time on the db (a MySQL named lock),
+    even if several web workers or command lines start one. removes the file at the end """
+    progress = progress or ImportProgress()
+    lock_db = get_database_connection()
+    lock_cur = lock_db.cursor()
+    try:
+        lock_cur.execute("SELECT GET_LOCK('sms_serial_import', %s)", (IMPORT_LOCK_TIMEOUT, ))
+        if not lock_cur.fetchone()[0]:
+            raise RuntimeError('another import is still running')
+        migrate_serial_numbers()
+        serials_count, _ = import_database_from_file(filepath, progress, invalids_path)
+        if delta and serials_count and {'serials', 'invalids'} <= _existing_tables(lock_cur):
+            counts, prefixes = apply_delta(progress)
+            overlapping = db_check('serials', 'invalids', progress, prefixes)
+            if any(counts.values()):
+                publish_generation(overlapping, prefixes)
+            _append_import_log(f"Delta applied: {counts['inserted']} serials inserted, {counts['updated']} updated, "
+                               f"{counts['deleted']} deleted; {counts['invalids_added']} invalids added, "
+                               f"{counts['invalids_removed']} removed")
+            progress.phase = 'done'
+            return
+        overlapping = db_check(SERIALS_NEW, INVALIDS_NEW, progress)
+        progress.start_phase('swap')
+        if serials_count:
+            swap_in_new_tables()
+            publish_generation(overlapping)
+            _append_import_log('New data is live')
+        else:
+            _append_import_log('No serials were imported; the current data is kept')
+        progress.phase = 'done'
+    except ImportCancelled:
+        progress.phase = 'cancelled'
+        _append_import_log('Import cancelled; the current data is kept')
+        raise
+    except Exception as e:
+        progress.phase = 'failed'
+        try:
+            _append_import_log(f'Import failed; the current data is kept. {e}')
+        except Exception as log_error:
+            print(f'can not write the import failure into the import log; {log_error}')
+        raise
+    finally:
+        try:
+            lock_cur.execute("SELECT RELEASE_LOCK('sms_serial_import')")
+        finally:
+            lock_db.close()
+            for path in (filepath, invalids_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--migrate':
+        migrate_serial_numbers()
+        sys.exit()
+
+    if sys.argv[1] == '--rollback':
+        if rollback():
+            publish_generation()
+        sys.exit()
+
+    delta = '--delta' in sys.argv
+    paths = [arg for arg in sys.argv[1:] if arg != '--delta']
+    run_import(paths[0], invalids_path=paths[1] if len(paths) > 1 else None, delta=delta)
@@ -0,0 +1,219 @@
+import collections
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+from import_db import ImportCancelled, ImportProgress
+
+JOBS_TABLE = 'import_jobs'
+ACTIVE_STATES = ('queued', 'running')
+
+
+def create_jobs_table(cur):
+    """ the jobs of all web workers, so any of them can show and cancel them """
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+        id INTEGER AUTO_INCREMENT PRIMARY KEY,
+        filename VARCHAR(255),
+        delta BOOLEAN,
+        state VARCHAR(20),
+        worker VARCHAR(100),
+        submitted DOUBLE,
+        finished DOUBLE,
+        error TEXT,
+        progress TEXT,
+        cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+        INDEX(state))""")
+
+
+class ImportQueue:
+    """ runs uploaded files through the importer one after the other in a
+    background thread of the web app, instead of starting a new python
+    process per upload. jobs can be cancelled while queued or running and
+    their live progress can be read at any time.
+    with get_connection the jobs are also kept in the import_jobs table, with the
+    progress saved after every batch: every web worker shows the same jobs and a
+    cancel sent to any of them reaches the worker running the job, which reads
+    the request with the next progress save """
+
+    def __init__(self, run_import, get_connection=None, keep_history=10):
+        self._run_import = run_import
+        self._get_connection = get_connection
+        self._keep_history = keep_history
+        self._queue = collections.deque()
+        self._history = collections.deque(maxlen=keep_history)
+        self._current = None
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='import-worker', daemon=True)
+            self._thread.start()
+
+    def submit(self, filepath, filename, invalids_path=None, delta=False):
+        """ queues a saved upload. returns the job id """
+        job = {'id': None, 'filename': filename, 'filepath': filepath,
+               'invalids_path': invalids_path, 'delta': delta, 'state': 'queued', 'worker': self._worker,
+               'submitted': time.time(), 'finished': None, 'error': None, 'progress': ImportProgress()}
+        if self._get_connection is None:
+            job['id'] = next(self._ids)
+        else:
+            db = self._get_connection()
+            try:
+                cur = db.cursor()
+                cur.execute(f"""INSERT INTO {JOBS_TABLE} (filename, delta, state, worker, submitted, progress)
+                                VALUES (%s, %s, %s, %s, %s, %s)""",
+                            (filename, delta, 'queued', self._worker, job['submitted'],
+                             json.dumps(job['progress'].as_dict())))
+                db.commit()
+                job['id'] = cur.lastrowid
+            finally:
+                db.close()
+        job['progress'].listener = lambda progress: self._save(job)
+        with self._cond:
+            self._queue.append(job)
+            self._start()
+            self._cond.notify()
+        return job['id']
+
+    def cancel(self, job_id):
+        """ cancels a queued or running job. returns False if there is no such job """
+        with self._cond:
+            for job in self._queue:
+                if job['id'] == job_id:
+                    self._queue.remove(job)
+                    break
+            else:
+                job = None
+                if self._current is not None and self._current['id'] == job_id:
+                    # the importer notices this at its next batch and stops
+                    self._current['progress'].cancelled = True
+                    return True
+        if job is not None:
+            self._finish(job, 'cancelled')
+            return True
+        if self._get_connection is None:
+            return False
+        # a job of another worker
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            cur.execute(f"UPDATE {JOBS_TABLE} SET cancel_requested = TRUE WHERE id = %s AND state IN %s",
+                        (job_id, ACTIVE_STATES))
+            db.commit()
+            return cur.rowcount > 0
+        finally:
+            db.close()
+
+    def _save(self, job):
+        """ writes the state and progress of a job and reads whether it was cancelled """
+        if self._get_connection is None:
+            return
+        try:
+            db = self._get_connection()
+            try:
+                cur = db.cursor()
+                cur.execute(f"""UPDATE {JOBS_TABLE} SET state = %s, finished = %s, error = %s, progress = %s
+                                WHERE id = %s""",
+                            (job['state'], job['finished'], job['error'], json.dumps(job['progress'].as_dict()),
+                             job['id']))
+                db.commit()
+                cur.execute(f"SELECT cancel_requested FROM {JOBS_TABLE} WHERE id = %s", (job['id'], ))
+                row = cur.fetchone()
+            finally:
+                db.close()
+        except Exception as e:
+            # the import goes on; only the other workers see an older progress
+            print(f'can not save import job {job["id"]}; {e}')
+            return
+        if row and row[0] and job['state'] in ACTIVE_STATES:
+            job['progress'].cancelled = True
+
+    def _finish(self, job, state, error=None):
+        job['state'] = state
+        job['error'] = error
+        job['finished'] = time.time()
+        if state == 'cancelled':
+            for path in (job['filepath'], job['invalids_path']):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        with self._cond:
+            self._history.appendleft(job)
+        self._save(job)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._current = self._queue.popleft()
+                job['state'] = 'running'
+            # another worker may have cancelled it while it was queued
+            self._save(job)
+            if job['progress'].cancelled:
+                state, error = 'cancelled', None
+            else:
+                try:
+                    self._run_import(job['filepath'], job['progress'], job['invalids_path'], job['delta'])
+                    state, error = 'done', None
+                except ImportCancelled:
+                    state, error = 'cancelled', None
+                except Exception as e:
+                    job['progress'].phase = 'failed'
+                    state, error = 'failed', str(e)
+            with self._cond:
+                self._current = None
+            self._finish(job, state, error)
+
+    @staticmethod
+    def _job_dict(job):
+        ret = {key: value for key, value in job.items() if key not in ('progress', 'filepath', 'invalids_path')}
+        ret['progress'] = job['progress'].as_dict()
+        return ret
+
+    def _local_status(self):
+        with self._cond:
+            current = self._job_dict(self._current) if self._current else None
+            return {'current': current,
+                    'queued': [self._job_dict(job) for job in self._queue],
+                    'history': [self._job_dict(job) for job in self._history]}
+
+    def _shared_status(self):
+        columns = 'id, filename, delta, state, worker, submitted, finished, error, progress'
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            cur.execute(f"SELECT {columns} FROM {JOBS_TABLE} WHERE state IN %s ORDER BY id", (ACTIVE_STATES, ))
+            active = cur.fetchall()
+            cur.execute(f"SELECT {columns} FROM {JOBS_TABLE} WHERE state NOT IN %s ORDER BY id DESC LIMIT %s",
+                        (ACTIVE_STATES, self._keep_history))
+            history = cur.fetchall()
+        finally:
+            db.close()
+
+        def job_dict(row):
+            job = dict(zip(('id', 'filename', 'delta', 'state', 'worker', 'submitted', 'finished', 'error'), row))
+            job['delta'] = bool(job['delta'])
+            job['progress'] = json.loads(row[-1]) if row[-1] else ImportProgress().as_dict()
+            return job
+
+        running = [job_dict(row) for row in active if row[3] == 'running']
+        # imports run one at a time on the db; a second running job waits for the first one
+        return {'current': running[0] if running else None,
+                'queued': running[1:] + [job_dict(row) for row in active if row[3] != 'running'],
+                'history': [job_dict(row) for row in history]}
+
+    def status(self):
+        """ the running job, the queued ones and the last finished ones,
+        of all workers if the jobs are kept in the db """
+        if self._get_connection is not None:
+            try:
+                return self._shared_status()
+            except Exception as e:
+                print(f'can not read the import jobs from the db, showing only this worker\'s; {e}')
+        return self._local_status()
@@ -0,0 +1,346 @@
+""" load generator for the webhook and the check api, with a fake KaveNegar.
+
+point the app at the fake gateway in config.py while testing:
+    SMS_API_URL = 'http://127.0.0.1:8099/v1'
+then, from the app folder:
+    python load_test.py gateway --latency 0.05 --error-rate 0.02
+    python load_test.py run --url http://127.0.0.1:5000 --rate 20,50,100,200 --duration 30
+--rate sends that many requests per second whatever the app does (latency is
+counted from when a request was due, so a saturated app shows up as growing
+latency); --concurrency keeps that many requests in flight instead. every
+comma separated value is one step, which makes the saturation point visible.
+`run --gateway-port 8099` starts the fake gateway in the same process.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import random
+import string
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote
+
+import requests
+
+KINDS = ('ok', 'failure', 'double', 'garbage')
+# what check_one_serial answers for each kind; garbage may be either
+EXPECTED = {'ok': ('OK', ), 'failure': ('FAILURE', ), 'double': ('DOUBLE', ), 'garbage': ('NOT-FOUND', 'FAILURE')}
+
+
+class FakeGateway:
+    """ answers send.json and sendarray.json like KaveNegar does, after
+    `latency` (+ up to `jitter`) seconds; `error_rate` of the calls fail """
+
+    def __init__(self, port=8099, latency=0.05, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._message_ids = iter(range(1, sys.maxsize))
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+                status, body = gateway.handle(self.path, form)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+
+    def handle(self, path, form):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if path.endswith('/sendarray.json'):
+            receptors = json.loads(form.get('receptor', '[]'))
+        elif path.endswith('/send.json'):
+            receptors = [form.get('receptor')]
+        else:
+            return 404, {'return': {'status': 404, 'message': 'not found'}}
+        with self._lock:
+            self.counters['calls'] += 1
+            if random.random() < self.error_rate:
+                self.counters['injected_errors'] += 1
+                return 502, {'return': {'status': 502, 'message': 'injected error'}}
+            self.counters['messages'] += len(receptors)
+            entries = [{'messageid': next(self._message_ids), 'receptor': receptor, 'status': 1,
+                        'statustext': 'queued'} for receptor in receptors]
+        return 200, {'return': {'status': 200, 'message': 'ok'}, 'entries': entries}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-gateway', daemon=True).start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def _human(serial):
+    """ AA0000000000000000000000000090 -> AA90, the way people type it """
+    from import_db import separate
+    letters, digits = separate(serial)
+    return f'{letters}{digits}'
+
+
+def garbage(rnd):
+    return rnd.choice((
+        lambda: ''.join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(1, 12))),
+        lambda: ''.join(rnd.choice(string.digits) for _ in range(rnd.randint(1, 20))),
+        lambda: 'سلام ' + str(rnd.randint(1, 999)),
+        lambda: 'ZZ' + str(rnd.randint(1, 10 ** 9)),
+    ))()
+
+
+def load_serials(path):
+    """ a csv file of `kind,serial` lines, kind being ok, failure or double """
+    serials = {kind: [] for kind in KINDS}
+    with open(path, encoding='utf-8') as lines:
+        for line in lines:
+            if ',' in line:
+                kind, serial = line.strip().split(',', 1)
+                if kind in serials:
+                    serials[kind].append(serial)
+    return serials
+
+
+def sample_serials(count, rnd):
+    """ picks serials of every kind from the current db, classified by the same
+    in-memory lookup the app uses """
+    from import_db import get_database_connection
+    from serial_index import SERIAL_COLUMNS, Snapshot
+
+    db = get_database_connection()
+    cur = db.cursor()
+    cur.execute(f"SELECT {SERIAL_COLUMNS} FROM serials")
+    rows = list(cur.fetchall())
+    cur.execute("SELECT invalid_serial FROM invalids")
+    invalids = [row[0] for row in cur.fetchall()]
+    db.close()
+
+    snapshot = Snapshot(rows, invalids)
+    serials = {kind: [] for kind in KINDS}
+    for row in rnd.sample(rows, min(len(rows), count * 4)):
+        status, _ = snapshot.lookup(row[3])
+        if status == 'OK' and len(serials['ok']) < count:
+            serials['ok'].append(_human(row[3]))
+        elif status == 'DOUBLE' and len(serials['double']) < count:
+            serials['double'].append(_human(row[3]))
+    serials['failure'] = [_human(serial) for serial in rnd.sample(invalids, min(len(invalids), count))]
+    return serials
+
+
+class Traffic:
+    """ picks what the next request is: which endpoint, which kind of serial """
+
+    def __init__(self, serials, mix, api_share, senders, seed):
+        self.rnd = random.Random(seed)
+        self.serials = serials
+        self.kinds = [kind for kind in KINDS if mix.get(kind) and (kind == 'garbage' or serials[kind])]
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.api_share = api_share
+        self.senders = [f'0912{self.rnd.randint(0, 9999999):07d}' for _ in range(senders)]
+        self._ids = iter(range(1, sys.maxsize))
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            kind = self.rnd.choices(self.kinds, self.weights)[0]
+            serial = garbage(self.rnd) if kind == 'garbage' else self.rnd.choice(self.serials[kind])
+            if self.rnd.random() < self.api_share:
+                return 'check_one_serial', kind, serial, None
+            return 'process', kind, serial, {'from': self.rnd.choice(self.senders), 'message': serial,
+                                             'messageid': f'load-{next(self._ids)}'}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.counters = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency, outcome):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.counters[endpoint][outcome] += 1
+
+
+def fire(session, args, traffic, recorder, due):
+    endpoint, kind, serial, form = traffic.next()
+    try:
+        if endpoint == 'process':
+            res = session.post(f'{args.url}/v1/{args.token}/process', data=form, timeout=args.timeout)
+        else:
+            res = session.get(f'{args.url}/v1/{args.api_key}/check_one_serial/{quote(serial, safe="")}',
+                              timeout=args.timeout)
+        if res.status_code != 200:
+            outcome = f'http_{res.status_code}'
+        elif endpoint == 'process':
+            outcome = res.json().get('message', 'unknown')
+        else:
+            outcome = 'ok' if res.json().get('status') in EXPECTED[kind] else 'wrong_answer'
+    except requests.RequestException as e:
+        outcome = type(e).__name__
+    recorder.add(endpoint, time.perf_counter() - due, outcome)
+
+
+def _session(local):
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def run_rate(args, traffic, rate):
+    """ open loop: a request is due every 1/rate seconds whether or not the
+    earlier ones are answered """
+    recorder = Recorder()
+    local = threading.local()
+    started = time.perf_counter()
+    total = int(rate * args.duration)
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as pool:
+        for i in range(total):
+            due = started + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(lambda due=due: fire(_session(local), args, traffic, recorder, due))
+    return recorder, time.perf_counter() - started
+
+
+def run_concurrency(args, traffic, concurrency):
+    """ closed loop: `concurrency` clients, each sending its next request as soon
+    as the last one is answered """
+    recorder = Recorder()
+    deadline = time.perf_counter() + args.duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            fire(session, args, traffic, recorder, time.perf_counter())
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0
+
+
+def summarize(recorder, elapsed):
+    report = {}
+    for endpoint in sorted(recorder.latencies):
+        samples = sorted(recorder.latencies[endpoint])
+        outcomes = recorder.counters[endpoint]
+        good = outcomes['ok'] + outcomes['processed'] + outcomes['queued'] + outcomes['throttled']
+        report[endpoint] = {'requests': len(samples),
+                            'per_sec': len(samples) / elapsed if elapsed else 0,
+                            'p50_ms': _percentile(samples, 0.50) * 1000,
+                            'p95_ms': _percentile(samples, 0.95) * 1000,
+                            'p99_ms': _percentile(samples, 0.99) * 1000,
+                            'error_rate': 1 - good / len(samples) if samples else 0,
+                            'outcomes': dict(outcomes)}
+    return report
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    mix = {kind: float(weight) for kind, weight in (part.split('=') for part in args.mix.split(','))}
+    serials = load_serials(args.serials) if args.serials else sample_serials(args.sample, rnd)
+    traffic = Traffic(serials, mix, args.api_share, args.senders, args.seed)
+    gateway = FakeGateway(args.gateway_port, args.latency, args.jitter, args.error_rate).start() \
+        if args.gateway_port else None
+
+    steps = args.concurrency or args.rate
+    results = {'meta': {'url': args.url, 'mode': 'concurrency' if args.concurrency else 'rate',
+                        'duration': args.duration, 'mix': mix, 'api_share': args.api_share,
+                        'serials': {kind: len(serials[kind]) for kind in KINDS}},
+               'steps': []}
+    print(f"{'step':>8} {'endpoint':18} {'requests':>9} {'per_sec':>9} {'p50_ms':>9} "
+          f"{'p95_ms':>9} {'p99_ms':>9} {'errors':>8}")
+    for step in (int(value) for value in steps.split(',')):
+        gateway_before = gateway.stats() if gateway else {}
+        if args.concurrency:
+            recorder, elapsed = run_concurrency(args, traffic, step)
+        else:
+            recorder, elapsed = run_rate(args, traffic, step)
+        report = summarize(recorder, elapsed)
+        for endpoint, line in report.items():
+            print(f"{step:>8} {endpoint:18} {line['requests']:>9} {line['per_sec']:9.1f} {line['p50_ms']:9.1f} "
+                  f"{line['p95_ms']:9.1f} {line['p99_ms']:9.1f} {line['error_rate'] * 100:7.1f}%")
+        if gateway:
+            after = gateway.stats()
+            report['gateway'] = {key: after.get(key, 0) - gateway_before.get(key, 0) for key in after}
+        results['steps'].append({'step': step, 'seconds': elapsed, 'endpoints': report})
+
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+def gateway(args):
+    FakeGateway(args.port, args.latency, args.jitter, args.error_rate).server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load test for the sms webhook and the check api')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def gateway_options(command, port_flag, port_default):
+        command.add_argument(port_flag, type=int, default=port_default)
+        command.add_argument('--latency', type=float, default=0.05, help='seconds per gateway call')
+        command.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds')
+        command.add_argument('--error-rate', type=float, default=0.0, help='fraction of failing gateway calls')
+
+    gateway_parser = commands.add_parser('gateway', help='run only the fake KaveNegar gateway')
+    gateway_options(gateway_parser, '--port', 8099)
+
+    run_parser = commands.add_parser('run', help='send load to a running app')
+    run_parser.add_argument('--url', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--token', help='CALL_BACK_TOKEN; read from config.py if not given')
+    run_parser.add_argument('--api-key', help='REMOTE_CALL_API_KEY; read from config.py if not given')
+    load = run_parser.add_mutually_exclusive_group()
+    load.add_argument('--rate', default='20', help='requests per second, comma separated steps')
+    load.add_argument('--concurrency', help='requests in flight, comma separated steps')
+    run_parser.add_argument('--duration', type=float, default=30, help='seconds per step')
+    run_parser.add_argument('--workers', type=int, default=200, help='threads sending in --rate mode')
+    run_parser.add_argument('--timeout', type=float, default=10)
+    run_parser.add_argument('--mix', default='ok=60,failure=15,double=5,garbage=20')
+    run_parser.add_argument('--api-share', type=float, default=0.2,
+                            help='fraction of requests going to check_one_serial instead of the webhook')
+    run_parser.add_argument('--senders', type=int, default=1000, help='distinct phone numbers')
+    run_parser.add_argument('--serials', help='csv of kind,serial lines; sampled from the db if not given')
+    run_parser.add_argument('--sample', type=int, default=1000, help='serials of each kind to sample')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--out', help='save the report as json to this file')
+    gateway_options(run_parser, '--gateway-port', None)
+
+    args = parser.parse_args(argv)
+    if args.command == 'gateway':
+        gateway(args)
+        return
+    if args.token is None or args.api_key is None:
+        import config
+        args.token = args.token or config.CALL_BACK_TOKEN
+        args.api_key = args.api_key or config.REMOTE_CALL_API_KEY
+    run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
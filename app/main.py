@@ -1,26 +1,41 @@
+import atexit
+import csv
 import datetime
+import functools
+import hashlib
+import io
 import os
 import re
+import sys
 import time
-import subprocess
+import zlib
 from textwrap import dedent
 
-import requests
 from flask import (
     Flask,
     Response,
     abort,
     flash,
+    g,
+    has_app_context,
     jsonify,
     redirect,
     render_template,
     request,
+    stream_with_context,
     url_for,
 )
 from werkzeug.utils import secure_filename
 
 import config
+import import_db
+import metrics
 import MySQLdb
+import MySQLdb.cursors
+import retention
+import rollups
+from db_pool import ConnectionPool, ReplicaRouter
+from dedup import IN_FLIGHT, CallbackDeduplicator, RedisStore
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_login import (
@@ -31,7 +46,13 @@ from flask_login import (
     login_user,
     logout_user,
 )
+from import_jobs import ImportQueue, create_jobs_table
 from pandas import read_excel
+from profiler import RequestProfiler
+from serial_index import DbSerialLookup, SerialIndex
+from sms_dispatcher import KavenegarTransport, SmsDispatcher, create_delivery_table
+from sms_logger import SmsLogWriter
+from throttle import WebhookThrottle
 
 app = Flask(__name__)
 limiter = Limiter(get_remote_address, app=app)
@@ -40,6 +61,39 @@ MAX_FLASH = 10
 UPLOAD_FOLDER = config.UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = config.ALLOWED_EXTENSIONS
 CALL_BACK_TOKEN = config.CALL_BACK_TOKEN
+SERIAL_INDEX_REFRESH = getattr(config, 'SERIAL_INDEX_REFRESH', 5)
+SERIAL_INDEX_IN_MEMORY = getattr(config, 'SERIAL_INDEX_IN_MEMORY', True)
+SMS_LOG_PAGE_SIZE = 100
+SMS_LOG_MAX_PAGE_SIZE = 1000
+SMS_EXPORT_CHUNK = 64 * 1024
+SMS_VOLUME_SPANS = {'hourly': (48, 24 * 31), 'daily': (30, 3 * 366)}  # default and max buckets
+MAX_BATCH_SERIALS = getattr(config, 'MAX_BATCH_SERIALS', 1000)
+API_CACHE_MAX_AGE = getattr(config, 'API_CACHE_MAX_AGE', 60)
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 10)
+DB_POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 10)
+MYSQL_REPLICAS = getattr(config, 'MYSQL_REPLICAS', [])
+MYSQL_REPLICA_MAX_LAG = getattr(config, 'MYSQL_REPLICA_MAX_LAG', 5)
+DB_CONNECT_TIMEOUT = getattr(config, 'DB_CONNECT_TIMEOUT', 3)
+SMS_SENDER = getattr(config, 'SMS_SENDER', None)
+SMS_API_URL = getattr(config, 'SMS_API_URL', 'https://api.kavenegar.com/v1')
+SMS_TIMEOUT = getattr(config, 'SMS_TIMEOUT', 10)
+SMS_BATCH_WINDOW = getattr(config, 'SMS_BATCH_WINDOW', 0.2)
+SMS_MAX_RETRIES = getattr(config, 'SMS_MAX_RETRIES', 3)
+SMS_LOG_BATCH = getattr(config, 'SMS_LOG_BATCH', 100)
+SMS_LOG_FLUSH_INTERVAL = getattr(config, 'SMS_LOG_FLUSH_INTERVAL', 1)
+SMS_LOG_SPILL_FILE = getattr(config, 'SMS_LOG_SPILL_FILE', None)
+SMS_ARCHIVE_FOLDER = getattr(config, 'SMS_ARCHIVE_FOLDER', 'archive')
+DEDUP_TTL = getattr(config, 'DEDUP_TTL', 600)
+DEDUP_MAX_ENTRIES = getattr(config, 'DEDUP_MAX_ENTRIES', 10000)
+DEDUP_REDIS_URL = getattr(config, 'DEDUP_REDIS_URL', None)
+WEBHOOK_LIMITS = getattr(config, 'WEBHOOK_LIMITS', [])
+WEBHOOK_LIMITS_STORAGE = getattr(config, 'WEBHOOK_LIMITS_STORAGE', 'memory://')
+WEBHOOK_QUEUE_SIZE = getattr(config, 'WEBHOOK_QUEUE_SIZE', 1000)
+PROFILER_ENDPOINTS = ('process', 'check_one_serial_api', 'home', 'db_status')
+PROFILER_SAMPLE_RATE = getattr(config, 'PROFILER_SAMPLE_RATE', 0.1)
+PROFILER_KEEP = getattr(config, 'PROFILER_KEEP', 20)
+PROFILER_INTERVAL = getattr(config, 'PROFILER_INTERVAL', 0.005)
+PROFILER_SYNC_INTERVAL = getattr(config, 'PROFILER_SYNC_INTERVAL', 2)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
@@ -51,8 +105,16 @@ login_manager.login_message_category = 'danger'
 
 
 def allowed_file(filename):
-    """ checks the extension of the passed filename to be in the allowed extensions"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    """ checks the passed filename to be a catalog type import_db can read with its
+    extension in the allowed extensions; a gzipped csv (.csv.gz) counts as csv.
+    parquet and arrow files are refused if pyarrow is not installed """
+    try:
+        kind = import_db.file_type(filename)
+    except ValueError:
+        return False
+    if kind in ('parquet', 'arrow') and not import_db.HAVE_PYARROW:
+        return False
+    return filename.lower().removesuffix('.gz').rsplit('.', 1)[-1] in ALLOWED_EXTENSIONS
 
 
 app.config.update(SECRET_KEY=config.SECRET_KEY)
@@ -77,7 +139,7 @@ def db_status():
     """ show some status about the DB """
 
     
-    db = get_database_connection()
+    db = get_read_connection()
     cur = db.cursor()
     
     # collect some stats for the GUI
@@ -112,14 +174,34 @@ def db_status():
         log_db_check = 'Can not read db_check logs... yet'
 
     return render_template('db_status.html', data={'serials': num_serials, 'invalids': num_invalids, 
-                                                   'log_import': log_import, 'log_db_check': log_db_check, 'log_filename': log_filename})
+                                                   'log_import': log_import, 'log_db_check': log_db_check, 'log_filename': log_filename,
+                                                   'import_jobs': import_jobs.status()})
+
+
+@app.route('/import_status', methods=['GET'])
+@login_required
+def import_status():
+    """ the running import (phase, rows done, rows/sec, ETA), queued ones and
+    the last finished ones as json. cheap enough to poll every few seconds """
+    return jsonify(import_jobs.status()), 200
+
+
+@app.route('/import/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_import(job_id):
+    """ cancels a queued or running import; the current data stays live """
+    if not import_jobs.cancel(job_id):
+        return jsonify({'message': 'no such queued or running import'}), 404
+    return jsonify({'message': 'cancelled'}), 200
 
 
 @app.route('/', methods=['GET', 'POST'])
 @login_required
 def home():
     """ creates database if method is post otherwise shows the homepage with some stats
-    see import_database_from_excel() for more details on database creation"""
+    see import_database_from_file() for more details on database creation
+    xlsx files hold both serials and invalids; csv, parquet and arrow files
+    need the invalids in a second file (invalids_file)"""
     if request.method == 'POST':
         # check if the post request has the file part
         if 'file' not in request.files:
@@ -132,55 +214,236 @@ def home():
             flash('No selected file', 'danger')
             return redirect(request.url)
         if file and allowed_file(file.filename):
+            invalids_file = request.files.get('invalids_file')
+            if not invalids_file or invalids_file.filename == '':
+                invalids_file = None
+            if import_db.file_type(file.filename) != 'xlsx' and invalids_file is None:
+                flash('csv, parquet and arrow catalogs need a second file with the invalid serials', 'danger')
+                return redirect(request.url)
+            if invalids_file is not None and not allowed_file(invalids_file.filename):
+                flash('File type of the invalids file is not supported', 'danger')
+                return redirect(request.url)
+
             #TODO: is space find in a file name? check if it works
             filename = secure_filename(file.filename)
             filename.replace(' ', '_') # no space in filenames! because we will call them as command line arguments
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # queued uploads must not overwrite each other
+            upload_id = time.strftime('%Y%m%d%H%M%S') + f'_{time.time_ns() % 1000000}'
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{upload_id}_{filename}')
             file.save(file_path)
-            subprocess.Popen(["python", "import_db.py", file_path])
+            invalids_path = None
+            if invalids_file is not None:
+                invalids_path = os.path.join(app.config['UPLOAD_FOLDER'],
+                                             f'{upload_id}_invalids_{secure_filename(invalids_file.filename)}')
+                invalids_file.save(invalids_path)
+            try:
+                import_jobs.submit(file_path, filename, invalids_path, delta=bool(request.form.get('delta')))
+            except Exception as e:
+                for path in (file_path, invalids_path):
+                    if path and os.path.exists(path):
+                        os.remove(path)
+                flash(f'Can not queue the import; {e}', 'danger')
+                return redirect(request.url)
             flash('File uploaded. Will be imported soon. follow from DB Status Page', 'info')
             return redirect('/')
+        flash('File type is not supported', 'danger')
+        return redirect(request.url)
 
-    db = get_database_connection()
+    db = get_read_connection()
 
     cur = db.cursor()
 
 
-    # get last 5000 sms
-    cur.execute("SELECT * FROM PROCESSED_SMS ORDER BY date DESC LIMIT 5000")
-    all_smss = cur.fetchall()
-    smss = []
-    for sms in all_smss:
-        status, sender, message, answer, date = sms
-        smss.append({'status': status, 'sender': sender, 'message': message, 'answer': answer, 'date': date})
-
-    # collect some stats for the GUI
+    # collect some stats for the GUI; the daily rollups also count what was archived
+    counts = {'OK': 0, 'FAILURE': 0, 'DOUBLE': 0, 'NOT-FOUND': 0}
     try:
-        cur.execute("SELECT count(*) FROM PROCESSED_SMS WHERE status = 'OK'")
-        num_ok = cur.fetchone()[0]
-    except: 
-        num_ok = 'error'
-
-    try:        
-        cur.execute("SELECT count(*) FROM PROCESSED_SMS WHERE status = 'FAILURE'")
-        num_failure = cur.fetchone()[0]
+        cur.execute(f"SELECT status, SUM(count) FROM {rollups.DAILY_TABLE} GROUP BY status")
+        for status, count in cur.fetchall():
+            if status in counts:
+                counts[status] = int(count)
     except:
-        num_failure = 'error'
+        counts = dict.fromkeys(counts, 'error')
+
+    # the sms table itself is loaded page by page from sms_log()
+    return render_template('index.html', data={'ok': counts['OK'], 'failure': counts['FAILURE'],
+                                               'double': counts['DOUBLE'], 'notfound': counts['NOT-FOUND']})
+
 
+@app.route('/sms_log', methods=['GET'])
+@login_required
+def sms_log():
+    """ one page of PROCESSED_SMS, newest first, as json.
+    the page is found by keyset (date, id) instead of OFFSET so every page is as
+    cheap as the first one. pass the returned next_cursor as cursor to get the
+    next page. sender (prefix) and status filter the results.
+    the archives (see retention.py) are only read when asked for with archived=1:
+    when the table runs out and there are archives, the answer says so with
+    next_archived and the next page is read from them """
     try:
-        cur.execute("SELECT count(*) FROM PROCESSED_SMS WHERE status = 'DOUBLE'")
-        num_double = cur.fetchone()[0]
-    except:
-        num_double = 'error'
+        limit = min(max(int(request.args.get('limit', SMS_LOG_PAGE_SIZE)), 1), SMS_LOG_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = SMS_LOG_PAGE_SIZE
+    conditions, params = [], []
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_date, cursor_id = cursor.rsplit('|', 1)
+            cursor_date = datetime.datetime.strptime(cursor_date, '%Y-%m-%d %H:%M:%S')
+            cursor_id = int(cursor_id)
+        except ValueError:
+            return jsonify({'message': 'bad cursor'}), 400
+        conditions.append("(date < %s OR (date = %s AND id < %s))")
+        params += [cursor_date, cursor_date, cursor_id]
+
+    status = request.args.get('status')
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    sender = request.args.get('sender')
+    if sender:
+        conditions.append("sender LIKE %s")
+        params.append(sender.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+
+    if request.args.get('archived') in ('1', 'true'):
+        before = (str(cursor_date), cursor_id) if cursor else None
+        smss = retention.read_archived(SMS_ARCHIVE_FOLDER, limit, before, status, sender)
+        next_cursor = f"{smss[-1]['date']}|{smss[-1]['id']}" if len(smss) == limit else None
+        return jsonify({'smss': smss, 'next_cursor': next_cursor, 'next_archived': True}), 200
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    db = get_read_connection()
+    cur = db.cursor()
+    cur.execute(f"""SELECT id, status, sender, message, answer, date FROM PROCESSED_SMS {where}
+                    ORDER BY date DESC, id DESC LIMIT %s""", params + [limit])
+    smss = []
+    for sms_id, sms_status, sms_sender, message, answer, date in cur.fetchall():
+        smss.append({'status': sms_status, 'sender': sms_sender, 'message': message, 'answer': answer,
+                     'date': str(date), 'id': sms_id})
+    db.close()
+
+    next_cursor, next_archived = None, False
+    if len(smss) == limit:
+        next_cursor = f"{smss[-1]['date']}|{smss[-1]['id']}"
+    elif retention.has_archives(SMS_ARCHIVE_FOLDER):
+        # the table ran out; the caller may go on in the archives
+        next_cursor = f"{smss[-1]['date']}|{smss[-1]['id']}" if smss else (cursor or '')
+        next_archived = True
+    return jsonify({'smss': smss, 'next_cursor': next_cursor, 'next_archived': next_archived}), 200
 
+
+@app.route('/sms_volume', methods=['GET'])
+@login_required
+def sms_volume():
+    """ message counts by status per hour (period=hourly, the last `span` hours)
+    or per day (period=daily, the last `span` days) for the dashboard charts.
+    read from the rollup tables, see rollups.py """
+    period = request.args.get('period', 'hourly')
+    if period not in SMS_VOLUME_SPANS:
+        return jsonify({'message': 'period is hourly or daily'}), 400
+    default_span, max_span = SMS_VOLUME_SPANS[period]
     try:
-        cur.execute("SELECT count(*) FROM PROCESSED_SMS WHERE status = 'NOT-FOUND'")
-        num_notfound = cur.fetchone()[0]
-    except:
-        num_notfound = 'error'
+        span = min(max(int(request.args.get('span', default_span)), 1), max_span)
+    except ValueError:
+        span = default_span
+
+    now = datetime.datetime.now()
+    if period == 'hourly':
+        since = now.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=span - 1)
+    else:
+        since = now.date() - datetime.timedelta(days=span - 1)
+    db = get_read_connection()
+    volume = rollups.read(db.cursor(), period, since)
+    db.close()
+    volume['period'] = period
+    return jsonify(volume), 200
+
+
+def _parse_export_date(text):
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f'bad date {text}')
+
+
+@app.route('/sms_export', methods=['GET'])
+@login_required
+def sms_export():
+    """ streams PROCESSED_SMS (and its archives) as csv, newest first.
+    filters: since and until (YYYY-mm-dd or YYYY-mm-dd HH:MM:SS; until is exclusive),
+    status and sender (prefix). gzip=1 sends a .csv.gz.
+    rows are read with a server side cursor and written out in chunks, so memory
+    use does not depend on the size of the export """
+    conditions, params = [], []
+    try:
+        since = _parse_export_date(request.args['since']) if request.args.get('since') else None
+        until = _parse_export_date(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'message': 'since and until are YYYY-mm-dd or YYYY-mm-dd HH:MM:SS'}), 400
+    if since:
+        conditions.append("date >= %s")
+        params.append(since)
+    if until:
+        conditions.append("date < %s")
+        params.append(until)
+    status = request.args.get('status')
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    sender = request.args.get('sender')
+    if sender:
+        conditions.append("sender LIKE %s")
+        params.append(sender.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    compress = request.args.get('gzip') in ('1', 'true')
+
+    def rows():
+        # not tracked in g: the response outlives the view function
+        db = read_router.acquire()
+        last = None
+        try:
+            cur = db.cursor(MySQLdb.cursors.SSCursor)
+            cur.execute(f"""SELECT id, status, sender, message, answer, date FROM PROCESSED_SMS {where}
+                            ORDER BY date DESC, id DESC""", params)
+            for row in cur:
+                last = row
+                yield row
+            cur.close()
+        finally:
+            db.close()
+        # older rows were moved to the archives by retention.py
+        before = (str(last[5]), last[0]) if last else (
+            (str(until - datetime.timedelta(seconds=1)), float('inf')) if until else None)
+        yield from retention.iter_archived(SMS_ARCHIVE_FOLDER, before, str(since) if since else None,
+                                           status, sender)
+
+    def generate():
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('id', 'status', 'sender', 'message', 'answer', 'date'))
+        # the header goes out at once so the download starts before the query is done
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+        for row in rows():
+            writer.writerow(row)
+            if buffer.tell() >= SMS_EXPORT_CHUNK:
+                data = buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+                yield compressor.compress(data) if compressor else data
+        data = buffer.getvalue().encode('utf-8')
+        yield compressor.compress(data) + compressor.flush() if compressor else data
+
+    filename = 'sms_export.csv.gz' if compress else 'sms_export.csv'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/gzip' if compress else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
-    return render_template('index.html', data={'smss': smss, 'ok': num_ok, 'failure': num_failure, 'double': num_double,
-                                               'notfound': num_notfound})
 
 @app.route("/login", methods=["GET", "POST"])
 @limiter.limit("10 per minute")
@@ -206,10 +469,65 @@ def check_one_serial_api(serial):
     """ to check whether a serial number is valid or not using api
     caller should use something like /v1/ABCDSECRET/check_one_serial/AA10000
     answer back json which is status = DOUBLE, FAILURE, OK, NOT-FOUND
+    the answer only changes with a new import, so it carries an ETag made of the
+    data generation and the normalized serial; a matching If-None-Match gets a
+    304 straight from memory. the match is weak since nginx weakens ETags when
+    it gzips
     """
-    status, answer = check_serial(serial)
+    snapshot = serial_index.snapshot()
+    etag = serial_etag(snapshot.generation, serial)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        metrics.count_result('NOT-MODIFIED', 'api')
+        return cacheable(Response(status=304), etag)
+
+    status, answer = check_serial(serial, snapshot)
+    metrics.count_result(status, 'api')
     ret = {'status': status, 'answer': answer}
-    return jsonify(ret), 200
+    return cacheable(jsonify(ret), etag), 200
+
+
+def serial_etag(generation, serial):
+    """ the ETag of the api answer for this serial in this data generation;
+    None before the first import published a generation """
+    if generation is None:
+        return None
+    return hashlib.sha1(f'{generation}:{normalize_string(serial)}'.encode()).hexdigest()
+
+
+def cacheable(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={API_CACHE_MAX_AGE}'
+    return response
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/check_serials", methods=["POST"])
+def check_serials_api():
+    """ checks many serials in one call. the body is either a json list of serials
+    (or {"serials": [...]}) or plain text with one serial per line.
+    answers back json like {"results": [{"serial": ..., "status": ..., "answer": ...}, ...]}
+    at most MAX_BATCH_SERIALS serials are accepted in one call
+    """
+    if request.is_json:
+        serials = request.get_json(silent=True)
+        if isinstance(serials, dict):
+            serials = serials.get('serials')
+    else:
+        serials = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
+
+    if not isinstance(serials, list) or not all(isinstance(serial, str) for serial in serials):
+        return jsonify({'message': 'send a json list of serials or one serial per line'}), 400
+    if len(serials) > MAX_BATCH_SERIALS:
+        return jsonify({'message': f'at most {MAX_BATCH_SERIALS} serials in one call'}), 413
+
+    # in db mode (SERIAL_INDEX_IN_MEMORY off) this reads all of them in two queries
+    snapshot = serial_index.snapshot([normalize_string(serial) for serial in serials])
+    results = []
+    for serial in serials:
+        status, answer = check_serial(serial, snapshot)
+        metrics.count_result(status, 'batch')
+        results.append({'serial': serial, 'status': status, 'answer': answer})
+    return jsonify({'results': results}), 200
 
 
 @app.route("/check_one_serial", methods=["POST"])
@@ -218,6 +536,7 @@ def check_one_serial():
     """ to check whether a serial number is valid or not"""
     serial_to_check = request.form["serial"]
     status, answer = check_serial(serial_to_check)
+    metrics.count_result(status, 'gui')
     flash(f'{status} - {answer}', 'info')
 
     return redirect('/')
@@ -246,6 +565,80 @@ def load_user(userid):
     return User(userid)
 
 
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/db_pool", methods=["GET"])
+def db_pool_stats_api():
+    """ database connection pool stats for monitoring:
+    size, in_use, idle, waiting, created, discarded, timeouts
+    and the lag and pools of the read replicas """
+    return jsonify(dict(db_pool.stats(), replicas=read_router.stats())), 200
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/sms_dispatcher", methods=["GET"])
+def sms_dispatcher_stats_api():
+    """ outgoing sms queue length, counters and the last delivery results """
+    return jsonify(sms_dispatcher.stats()), 200
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/sms_log_writer", methods=["GET"])
+def sms_log_writer_stats_api():
+    """ buffered, written, spilled and dropped counts of the PROCESSED_SMS writer """
+    return jsonify(sms_log_writer.stats()), 200
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/dedup", methods=["GET"])
+def dedup_stats_api():
+    """ how many webhook callbacks were new and how many were duplicates """
+    return jsonify(callback_dedup.stats()), 200
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/webhook_throttle", methods=["GET"])
+def webhook_throttle_stats_api():
+    """ how many webhook messages were dropped, queued or noticed by the rate policies """
+    return jsonify(webhook_throttle.stats()), 200
+
+
+@app.route(f"/v1/{config.REMOTE_CALL_API_KEY}/metrics", methods=["GET"])
+def metrics_api():
+    """ per stage latency histograms, answer status counters and queue sizes
+    in the Prometheus text format """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profiler', methods=['GET', 'POST'])
+@login_required
+def profiler_api():
+    """ GET tells whether the profiler is on in each worker process and lists the slowest
+    requests all of them kept. POST enabled=1 (optionally with sample_rate and keep) switches
+    it on, enabled=0 off and clear=1 forgets the kept requests; the other workers follow
+    within PROFILER_SYNC_INTERVAL seconds. see profiler.py """
+    if request.method == 'POST':
+        form = request.get_json(silent=True) or request.form
+        try:
+            sample_rate = float(form['sample_rate']) if form.get('sample_rate') not in (None, '') else None
+            keep = int(form['keep']) if form.get('keep') not in (None, '') else None
+        except (TypeError, ValueError):
+            return jsonify({'message': 'sample_rate is a number between 0 and 1, keep a number'}), 400
+        if (sample_rate is not None and not 0 <= sample_rate <= 1) or (keep is not None and keep < 1):
+            return jsonify({'message': 'sample_rate is a number between 0 and 1, keep a number'}), 400
+        enabled = {'1': True, 'true': True, 'True': True, '0': False, 'false': False, 'False': False}.get(
+            str(form.get('enabled')))
+        try:
+            request_profiler.configure(enabled, sample_rate, keep, clear=str(form.get('clear')) in ('1', 'true', 'True'))
+        except Exception as e:
+            return jsonify({'message': f'changed only in worker {request_profiler.worker}, '
+                                       f'the other workers did not get it; {e}'}), 503
+    return jsonify(request_profiler.status()), 200
+
+
+@app.route('/profiler/flamegraph', methods=['GET'])
+@login_required
+def profiler_flamegraph():
+    """ the kept profiles (or the one given by id) as collapsed stacks for flamegraph.pl or speedscope """
+    collapsed = request_profiler.collapsed(request.args.get('id'))
+    return Response(collapsed, mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=profile.folded'})
+
+
 @app.route('/v1/ok')
 def health_check():
     """ for system health check. calling it will answer with json message: ok """
@@ -253,21 +646,121 @@ def health_check():
     return jsonify(ret), 200
 
 
+def _connect_to_database(**server):
+    """connects to the MySQL database and returns the connection.
+    server (host, port, user, passwd) overrides the primary's settings"""
+    settings = dict(host=config.MYSQL_HOST,
+                    user=config.MYSQL_USERNAME,
+                    passwd=config.MYSQL_PASSWORD,
+                    db=config.MYSQL_DB_NAME,
+                    charset='utf8',
+                    connect_timeout=DB_CONNECT_TIMEOUT)
+    settings.update(server)
+    return MySQLdb.connect(**settings)
+
+
+db_pool = ConnectionPool(_connect_to_database, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+# a replica is given as a host name or as a dict of connection settings
+_replica_servers = [replica if isinstance(replica, dict) else {'host': replica} for replica in MYSQL_REPLICAS]
+read_router = ReplicaRouter(
+    db_pool,
+    [(f"{server['host']}:{server.get('port', 3306)}",
+      ConnectionPool(functools.partial(_connect_to_database, **server), DB_POOL_SIZE, DB_POOL_TIMEOUT))
+     for server in _replica_servers],
+    max_lag=MYSQL_REPLICA_MAX_LAG)
+
+
+def _track(db):
+    if has_app_context():
+        g.setdefault('db_connections', []).append(db)
+    return db
+
+
 def get_database_connection():
-    """connects to the MySQL database and returns the connection"""
-    return MySQLdb.connect(host=config.MYSQL_HOST,
-                           user=config.MYSQL_USERNAME,
-                           passwd=config.MYSQL_PASSWORD,
-                           db=config.MYSQL_DB_NAME,
-                           charset='utf8')
+    """checks out a connection to the primary from the pool. closing it returns it to the pool.
+    inside a request, whatever is not closed is returned when the request ends.
+    everything which writes has to use this one"""
+    with metrics.stage('db_checkout'):
+        db = db_pool.acquire()
+    metrics.count_route('primary', 'write')
+    return _track(db)
+
+
+def get_read_connection():
+    """like get_database_connection, but for read-only queries: the connection is to a
+    replica which is not lagging behind (see MYSQL_REPLICAS) or to the primary"""
+    with metrics.stage('db_checkout'):
+        db = read_router.acquire()
+    return _track(db)
+
+
+@app.teardown_appcontext
+def return_database_connections(exception):
+    """ gives back all connections checked out during this request """
+    for db in g.pop('db_connections', []):
+        db.close()
+
+
+if SERIAL_INDEX_IN_MEMORY:
+    serial_index = SerialIndex(get_read_connection, SERIAL_INDEX_REFRESH)
+else:
+    serial_index = DbSerialLookup(get_read_connection, SERIAL_INDEX_REFRESH)
+import_jobs = ImportQueue(import_db.run_import, get_database_connection)
+
+
+sms_dispatcher = SmsDispatcher(KavenegarTransport(config.API_KEY, SMS_SENDER, SMS_TIMEOUT, SMS_API_URL),
+                               batch_window=SMS_BATCH_WINDOW, max_retries=SMS_MAX_RETRIES,
+                               get_connection=get_database_connection)
+atexit.register(sms_dispatcher.stop)
+sms_log_writer = SmsLogWriter(get_database_connection, SMS_LOG_BATCH, SMS_LOG_FLUSH_INTERVAL,
+                              spill_path=SMS_LOG_SPILL_FILE)
+atexit.register(sms_log_writer.stop)
+callback_dedup = CallbackDeduplicator(DEDUP_MAX_ENTRIES, DEDUP_TTL,
+                                      shared_store=RedisStore(DEDUP_REDIS_URL) if DEDUP_REDIS_URL else None)
+webhook_throttle = WebhookThrottle(WEBHOOK_LIMITS, WEBHOOK_LIMITS_STORAGE, WEBHOOK_QUEUE_SIZE)
+request_profiler = RequestProfiler(app, PROFILER_ENDPOINTS, PROFILER_SAMPLE_RATE, PROFILER_KEEP, PROFILER_INTERVAL,
+                                   get_database_connection, PROFILER_SYNC_INTERVAL)
+
+
+@app.before_request
+def sync_profiler():
+    """ follows the profiler settings every worker shares """
+    request_profiler.sync()
+
+
+def _collect_gauges():
+    """ current sizes of pools and queues for the metrics endpoint """
+    for name, value in db_pool.stats().items():
+        yield f'sms_db_pool_{name}', {}, value
+    for replica, state in read_router.stats().items():
+        if state['lag'] is not None and state['lag'] != float('inf'):
+            yield 'sms_db_replica_lag_seconds', {'replica': replica}, state['lag']
+        yield 'sms_db_replica_down', {'replica': replica}, int(state['down'])
+    dispatcher = sms_dispatcher.stats()
+    yield 'sms_dispatcher_queue', {}, dispatcher['queue']
+    yield 'sms_dispatcher_retry_queue', {}, dispatcher['retry_queue']
+    for name, value in dispatcher['counters'].items():
+        yield 'sms_dispatcher_events', {'event': name}, value
+    writer = sms_log_writer.stats()
+    yield 'sms_log_writer_buffer', {}, writer['buffer']
+    for name, value in writer['counters'].items():
+        yield 'sms_log_writer_events', {'event': name}, value
+    for name, value in callback_dedup.stats()['counters'].items():
+        yield 'sms_dedup_events', {'event': name}, value
+    throttle = webhook_throttle.stats()
+    yield 'sms_webhook_queue', {}, throttle['queue']
+    for name, value in throttle['counters'].items():
+        yield 'sms_webhook_throttle_events', {'event': name}, value
+
+
+metrics.add_collector(_collect_gauges)
 
 
 def send_sms(receptor, message):
-    """ gets a MSISDN and a message, then uses KaveNegar to send sms."""
-    url = f'https://api.kavenegar.com/v1/{config.API_KEY}/sms/send.json'
-    data = {"message": message,
-            "receptor": receptor}
-    res = requests.post(url, data)
+    """ gets a MSISDN and a message, then queues it to be sent by KaveNegar.
+    sending happens in the background; see sms_dispatcher.py"""
+    return sms_dispatcher.send(receptor, message)
 
 
 def _remove_non_alphanum_char(string):
@@ -302,49 +795,49 @@ def normalize_string(serial_number, fixed_size=30):
 
 
 
-def check_serial(serial):
+def check_serial(serial, index=None):
     """ gets one serial number and returns appropriate
     answer to that, after looking it up in the db
+    lookups are served from serial_index which is a memory copy of the db
+    (or the db itself when SERIAL_INDEX_IN_MEMORY is off);
+    pass a snapshot as index to check many serials against the same data
     """
     original_serial = serial
-    serial = normalize_string(serial)
-
-    db = get_database_connection()
-
-    with db.cursor() as cur:
-        results = cur.execute("SELECT * FROM invalids WHERE invalid_serial = %s", (serial,))
-        if results > 0:
-            answer = dedent(f"""\
-                {original_serial}
-                این شماره هولوگرام یافت نشد. لطفا دوباره سعی کنید  و یا با واحد پشتیبانی تماس حاصل فرمایید.
-                ساختار صحیح شماره هولوگرام بصورت دو حرف انگلیسی و 7 یا 8 رقم در دنباله آن می باشد. مثال:
-                FA1234567
-                شماره تماس با بخش پشتیبانی فروش شرکت التک:
-                021-22038385""")
-
-            return 'FAILURE', answer
-
-        results = cur.execute("SELECT * FROM serials WHERE start_serial <= %s and end_serial >= %s", (serial, serial))
-        if results > 1:
-            answer = dedent(f"""\
-                {original_serial}
-                این شماره هولوگرام مورد تایید است.
-                برای اطلاعات بیشتر از نوع محصول با بخش پشتیبانی فروش شرکت التک تماس حاصل فرمایید:
-                021-22038385""")
-            return 'DOUBLE', answer
-        elif results == 1:
-            ret = cur.fetchone()
-            desc = ret[2]
-            ref_number = ret[1]
-            date = ret[5].date()
-            rettext = ret[6] + '\n' + ret[7]
-            answer = dedent(f"""{original_serial}
+    with metrics.stage('normalize'):
+        serial = normalize_string(serial)
+
+    with metrics.stage('lookup'):
+        status, ret = (index or serial_index).lookup(serial)
+
+    if status == 'FAILURE':
+        answer = dedent(f"""\
+            {original_serial}
+            این شماره هولوگرام یافت نشد. لطفا دوباره سعی کنید  و یا با واحد پشتیبانی تماس حاصل فرمایید.
+            ساختار صحیح شماره هولوگرام بصورت دو حرف انگلیسی و 7 یا 8 رقم در دنباله آن می باشد. مثال:
+            FA1234567
+            شماره تماس با بخش پشتیبانی فروش شرکت التک:
+            021-22038385""")
+
+        return 'FAILURE', answer
+
+    if status == 'DOUBLE':
+        answer = dedent(f"""\
+            {original_serial}
+            این شماره هولوگرام مورد تایید است.
+            برای اطلاعات بیشتر از نوع محصول با بخش پشتیبانی فروش شرکت التک تماس حاصل فرمایید:
+            021-22038385""")
+        return 'DOUBLE', answer
+    elif status == 'OK':
+        desc = ret[2]
+        ref_number = ret[1]
+        date = ret[5].date()
+        rettext = ret[6] + '\n' + ret[7]
+        answer = dedent(f"""{original_serial}
 {ref_number}
 {desc}
 Hologram date: {date}
 {rettext}""")
-            return 'OK', answer
-
+        return 'OK', answer
 
     answer = dedent(f"""\
         {original_serial}
@@ -362,32 +855,65 @@ def process():
     """ this is a call back from KaveNegar. Will get sender and message and
     will check if it is valid, then answers back.
     This is secured by 'CALL_BACK_TOKEN' in order to avoid mal-intended calls
+    Repeated callbacks of the same sms are answered once; see dedup.py
+    Senders over the WEBHOOK_LIMITS are handled before any db work; see throttle.py
     """
     data = request.form
     sender = data["from"]
     message = data["message"]
 
+    # the gateway retries callbacks after a timeout; answer those from memory.
+    # a retry of a callback which is still being processed gets a 409, so the
+    # gateway tries again in case that first attempt fails
+    key, stored = callback_dedup.claim(data)
+    if stored is not None:
+        return jsonify(stored), 409 if stored == IN_FLIGHT else 200
+
+    try:
+        decision = webhook_throttle.check(sender)
+        if decision is None:
+            handle_sms(sender, message)
+            ret = {"message": "processed"}
+        else:
+            ret = throttled(decision, sender, message)
+    except Exception:
+        callback_dedup.forget(key)
+        raise
+    callback_dedup.done(key, ret)
+    return jsonify(ret), 200
+
+
+def handle_sms(sender, message):
+    """ checks the serial in the message, logs it and answers the sender """
     status, answer = check_serial(message)
+    metrics.count_result(status, 'sms')
 
-    db = get_database_connection()
+    with metrics.stage('log_new_sms'):
+        log_new_sms(status, sender, message, answer)
 
-    cur = db.cursor()
+    with metrics.stage('send_sms'):
+        send_sms(sender, answer)
 
-    log_new_sms(status, sender, message, answer, cur)
-    
-    db.commit()
-    db.close()
 
-    send_sms(sender, answer)
-    ret = {"message": "processed"}
-    return jsonify(ret), 200
+def throttled(decision, sender, message):
+    """ applies the action of the rate policy this sender is over """
+    action, notify, waiting = decision
+    if action == 'queue' and webhook_throttle.postpone(sender, message, handle_sms, waiting):
+        return {"message": "queued"}
+    if notify:
+        send_sms(sender, dedent("""\
+            تعداد پیام های شما بیش از حد مجاز است.
+            لطفا چند دقیقه دیگر دوباره سعی کنید."""))
+    return {"message": "throttled"}
 
-def log_new_sms(status, sender, message, answer, cur):
+def log_new_sms(status, sender, message, answer):
+    """ queues the sms to be written into PROCESSED_SMS in the background
+    (see sms_logger.py). too long messages are not logged """
     if len(message) > 40:
         return
     now = time.strftime('%Y-%m-%d %H:%M:%S')
-    cur.execute("INSERT INTO PROCESSED_SMS (status, sender, message, answer, date) VALUES (%s, %s, %s, %s, %s)", (status, sender, message, answer, now))
-    
+    sms_log_writer.log(status, sender, message, answer, now)
+
 @app.errorhandler(404)
 def page_not_found(error):
     """ returns 404 page"""
@@ -396,7 +922,9 @@ def page_not_found(error):
 
 
 def create_sms_table():
-    """Creates PROCESSED_SMS table on database if it's not exists."""
+    """Creates PROCESSED_SMS table on database if it's not exists.
+    tables from older versions get the id column and the indexes the sms log needs.
+    also creates the rollup tables and fills them from the log the first time"""
 
     db = get_database_connection()
 
@@ -408,14 +936,70 @@ def create_sms_table():
             sender CHAR(20),
             message VARCHAR(400),
             answer VARCHAR(400),
-            date DATETIME, INDEX(date, status));""")
+            date DATETIME NOT NULL,
+            id BIGINT AUTO_INCREMENT,
+            PRIMARY KEY(id, date),
+            INDEX(date, id), INDEX(date, status), INDEX(status, date), INDEX(sender, date))
+            """ + retention.current_partition_clause())
+        db.commit()
+
+        cur.execute("SHOW COLUMNS FROM PROCESSED_SMS LIKE 'id'")
+        if not cur.fetchall():
+            cur.execute("ALTER TABLE PROCESSED_SMS ADD COLUMN id BIGINT AUTO_INCREMENT PRIMARY KEY")
+        cur.execute("SHOW INDEX FROM PROCESSED_SMS")
+        indexes = {}
+        for row in cur.fetchall():
+            indexes.setdefault(row[2], []).append(row[4])
+        first_columns = {columns[0] for columns in indexes.values()}
+        # the sms log pages and the export read ORDER BY date DESC, id DESC from it
+        if ['date', 'id'] not in [columns[:2] for columns in indexes.values()]:
+            cur.execute("ALTER TABLE PROCESSED_SMS ADD INDEX(date, id)")
+        if 'status' not in first_columns:
+            cur.execute("ALTER TABLE PROCESSED_SMS ADD INDEX(status, date)")
+        if 'sender' not in first_columns:
+            cur.execute("ALTER TABLE PROCESSED_SMS ADD INDEX(sender, date)")
+        db.commit()
+    except Exception as e:
+        print(f'Error creating PROCESSED_SMS table; {e}')
+
+    try:
+        rollups.create_tables(cur)
         db.commit()
+        # first start with rollups; count what was logged before them
+        cur.execute(f"SELECT 1 FROM {rollups.DAILY_TABLE} LIMIT 1")
+        if not cur.fetchall():
+            rollups.backfill(db)
     except Exception as e:
-        flash(f'Error creating PROCESSED_SMS table; {e}', 'danger')
-        
+        print(f'Error creating the sms rollup tables; {e}')
+
     db.close()
 
 
+def migrate_database():
+    """ creates and migrates all tables: PROCESSED_SMS with its rollups, logs, the import
+    jobs, SMS_DELIVERY and the numeric serial columns. this can rewrite big tables, so requests never
+    do it: run `python main.py --migrate` before starting the app after an upgrade
+    (`python main.py` does it before it serves). a second run at the same time waits
+    for the first one """
+    db = get_database_connection()
+    try:
+        cur = db.cursor()
+        cur.execute("SELECT GET_LOCK('sms_schema', 600)")
+        try:
+            create_sms_table()
+            import_db.create_logs_table(cur)
+            create_jobs_table(cur)
+            create_delivery_table(cur)
+            db.commit()
+            import_db.migrate_serial_numbers()
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('sms_schema')")
+    finally:
+        db.close()
+
+
 if __name__ == "__main__":
-    create_sms_table()
+    migrate_database()
+    if '--migrate' in sys.argv[1:]:
+        sys.exit()
     app.run("0.0.0.0", 5000, debug=False)
@@ -0,0 +1,159 @@
+""" small in-process metrics: per stage latency histograms, counters and
+gauges, rendered in the Prometheus text format.
+recording is a perf_counter call and a few additions; nothing else
+happens until someone scrapes the metrics endpoint """
+import bisect
+import threading
+import time
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STAGE_HISTOGRAM = 'sms_stage_seconds'
+RESULTS_COUNTER = 'sms_results_total'
+ROUTES_COUNTER = 'sms_db_routes_total'
+
+HELP = {
+    STAGE_HISTOGRAM: 'Time spent in each stage of the verification pipeline',
+    RESULTS_COUNTER: 'Checked serials by answer status and where the request came from',
+    ROUTES_COUNTER: 'Database connections handed out by target server and why',
+}
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    inner = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in labels)
+    return '{' + inner + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add_collector(self, collector):
+        """ collector() is called on every scrape and returns (name, labels dict, value)
+        gauges, e.g. the current size of a queue """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        by_name = {}
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+        for (name, labels), histogram in histograms:
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name in sorted(by_name):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(by_name[name], key=lambda item: item[0]):
+                counts, total, count = histogram.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets + ('+Inf', ), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_labels_text(labels + (("le", bound), ))} {cumulative}')
+                lines.append(f'{name}_sum{_labels_text(labels)} {total}')
+                lines.append(f'{name}_count{_labels_text(labels)} {count}')
+
+        seen = set()
+        for (name, labels), value in sorted(counters):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_labels_text(labels)} {value}')
+
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception:
+                continue
+        for name in sorted(gauges):
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in gauges[name]:
+                lines.append(f'{name}{_labels_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def stage(name):
+    """ times a block of code as one stage of the pipeline:
+        with metrics.stage('normalize'):
+            ...
+    """
+    return _Timer(REGISTRY.histogram(STAGE_HISTOGRAM, stage=name))
+
+
+def count_result(status, source):
+    REGISTRY.inc(RESULTS_COUNTER, status=status, source=source)
+
+
+def count_route(target, reason):
+    REGISTRY.inc(ROUTES_COUNTER, target=target, reason=reason)
+
+
+def add_collector(collector):
+    REGISTRY.add_collector(collector)
+
+
+def render():
+    return REGISTRY.render()
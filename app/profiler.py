@@ -0,0 +1,353 @@
+""" an on-demand sampling profiler for a few flask views.
+
+while it is on, a `sample_rate` fraction of the requests to the profiled views
+is watched: a background thread samples the call stack of the request thread
+every `interval` seconds and every SQL statement run on a pooled connection is
+timed. the `keep` slowest requests are kept and can be downloaded as collapsed
+stacks (the input of flamegraph.pl, speedscope, ...).
+while it is off nothing is wrapped, so the views run exactly as without it.
+
+every web worker process has its own profiler. with get_connection they share
+it through the logs table: the 'profiler' row holds the settings, which each
+worker reads before a request (at most every `sync_interval` seconds), and
+each worker writes its kept requests into its own 'profiler:<host>:<pid>' row,
+so any worker can show all of them """
+import collections
+import functools
+import heapq
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from flask import request
+
+from db_pool import PooledConnection
+
+SETTINGS_LOG_NAME = 'profiler'
+WORKER_LOG_PREFIX = 'profiler:'
+
+
+class _Profile:
+    def __init__(self, number, endpoint, method, path):
+        self.number = number
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.duration = None
+        self.stacks = collections.Counter()
+        self.queries = []
+        self.current_query = None
+        self.thread_id = threading.get_ident()
+
+    def summary(self):
+        sql_seconds = sum(seconds for _, seconds in self.queries)
+        slowest = sorted(self.queries, key=lambda query: query[1], reverse=True)[:5]
+        return {'id': f'{os.getpid()}-{self.number}', 'pid': os.getpid(),
+                'endpoint': self.endpoint, 'method': self.method, 'path': self.path,
+                'started': self.started, 'duration_ms': round(self.duration * 1000, 2),
+                'sql_ms': round(sql_seconds * 1000, 2), 'sql_count': len(self.queries),
+                'slowest_sql': [{'sql': sql, 'ms': round(seconds * 1000, 2)} for sql, seconds in slowest],
+                'samples': sum(self.stacks.values())}
+
+
+class _TimedCursor:
+    """ times execute and executemany of a cursor into the profile of the request using it """
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, query, *args):
+        sql = ' '.join(str(query).split())[:200]
+        self._profile.current_query = sql
+        started = time.perf_counter()
+        try:
+            return method(query, *args)
+        finally:
+            self._profile.queries.append((sql, time.perf_counter() - started))
+            self._profile.current_query = None
+
+    def execute(self, query, *args):
+        return self._timed(self._cursor.execute, query, *args)
+
+    def executemany(self, query, *args):
+        return self._timed(self._cursor.executemany, query, *args)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+
+
+class RequestProfiler:
+    def __init__(self, app, endpoints, sample_rate=0.1, keep=20, interval=0.005,
+                 get_connection=None, sync_interval=2.0):
+        self.app = app
+        self.endpoints = tuple(endpoints)
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.interval = interval
+        self.enabled = False
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.sync_interval = sync_interval
+        self._get_connection = get_connection
+        self._originals = {}
+        self._active = {}          # thread id -> _Profile
+        self._slowest = []         # heap of (duration, id, _Profile)
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sync_lock = threading.Lock()
+        self._synced = None        # time.monotonic() of the last sync
+        self._clears = None        # the clear count of the shared settings, when last read
+        self._changed = True       # the kept requests changed since they were last shared
+        self._sync_error = None
+
+    # switching on and off
+
+    def enable(self, sample_rate=None, keep=None):
+        with self._lock:
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            if keep is not None:
+                self.keep = keep
+            self._changed = True
+            if self.enabled:
+                return
+            for endpoint in self.endpoints:
+                view = self.app.view_functions.get(endpoint)
+                if view is not None:
+                    self._originals[endpoint] = view
+                    self.app.view_functions[endpoint] = self._wrap(view)
+            profiler = self
+
+            def cursor(connection, *args):
+                cur = connection.__getattr__('cursor')(*args)
+                profile = profiler._active.get(threading.get_ident())
+                return _TimedCursor(cur, profile) if profile is not None else cur
+            PooledConnection.cursor = cursor
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.app.view_functions.update(self._originals)
+            self._originals.clear()
+            del PooledConnection.cursor
+            self.enabled = False
+            self._changed = True
+
+    def clear(self):
+        with self._lock:
+            self._slowest = []
+            self._changed = True
+
+    def configure(self, enabled=None, sample_rate=None, keep=None, clear=False):
+        """ switches the profiler on (enabled=True) or off (enabled=False) and forgets
+        the kept requests (clear) in this worker and in the shared settings, which
+        the other workers follow at their next sync """
+        if clear:
+            self.clear()
+        if enabled is True:
+            self.enable(sample_rate, keep)
+        elif enabled is False:
+            self.disable()
+        if self._get_connection is None:
+            return
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            settings = self._read_settings(cur) or {'clears': 0}
+            settings.update(enabled=self.enabled, sample_rate=self.sample_rate, keep=self.keep)
+            if clear:
+                settings['clears'] += 1
+                cur.execute("DELETE FROM logs WHERE log_name LIKE %s", (WORKER_LOG_PREFIX + '%', ))
+            self._clears = settings['clears']
+            cur.execute("DELETE FROM logs WHERE log_name = %s", (SETTINGS_LOG_NAME, ))
+            cur.execute("INSERT INTO logs VALUES (%s, %s)", (SETTINGS_LOG_NAME, json.dumps(settings)))
+            self._publish(cur)
+            db.commit()
+        finally:
+            db.close()
+
+    # sharing it between the worker processes
+
+    @staticmethod
+    def _read_settings(cur):
+        cur.execute("SELECT log_value FROM logs WHERE log_name = %s", (SETTINGS_LOG_NAME, ))
+        row = cur.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _apply(self, settings):
+        if self._clears is not None and settings['clears'] != self._clears:
+            self.clear()
+        self._clears = settings['clears']
+        if settings['enabled']:
+            if (not self.enabled or self.sample_rate != settings['sample_rate']
+                    or self.keep != settings['keep']):
+                self.enable(settings['sample_rate'], settings['keep'])
+        else:
+            self.disable()
+
+    def _publish(self, cur):
+        """ writes the state and the kept requests of this worker into its row """
+        with self._lock:
+            kept = [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+            self._changed = False
+        state = {'worker': self.worker, 'pid': os.getpid(), 'enabled': self.enabled,
+                 'sample_rate': self.sample_rate, 'keep': self.keep, 'updated': time.time(),
+                 'profiles': [dict(profile.summary(), worker=self.worker, stacks=dict(profile.stacks))
+                              for profile in kept]}
+        name = WORKER_LOG_PREFIX + self.worker
+        cur.execute("DELETE FROM logs WHERE log_name = %s", (name, ))
+        cur.execute("INSERT INTO logs VALUES (%s, %s)", (name, json.dumps(state)))
+
+    def sync(self, force=False):
+        """ follows the shared settings and shares the kept requests if they changed.
+        called before every request; it does nothing for sync_interval seconds
+        after a sync, so the db is read at most that often per worker """
+        if self._get_connection is None or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            if not force and self._synced is not None and time.monotonic() - self._synced < self.sync_interval:
+                return
+            self._synced = time.monotonic()
+            db = self._get_connection()
+            try:
+                cur = db.cursor()
+                settings = self._read_settings(cur)
+                if settings is not None:
+                    self._apply(settings)
+                if self._changed:
+                    self._publish(cur)
+                    db.commit()
+            finally:
+                db.close()
+            self._sync_error = None
+        except Exception as e:
+            # the worker goes on with its own state until the db answers again
+            if str(e) != self._sync_error:
+                print(f'can not sync the profiler with the db; {e}')
+            self._sync_error = str(e)
+        finally:
+            self._sync_lock.release()
+
+    # profiling one request
+
+    def _wrap(self, view):
+        @functools.wraps(view)
+        def profiled(*args, **kwargs):
+            if random.random() >= self.sample_rate:
+                return view(*args, **kwargs)
+            profile = _Profile(next(self._numbers), request.endpoint, request.method, request.path)
+            self._begin(profile)
+            started = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                profile.duration = time.perf_counter() - started
+                self._end(profile)
+        return profiled
+
+    def _begin(self, profile):
+        with self._lock:
+            self._active[profile.thread_id] = profile
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+
+    def _end(self, profile):
+        with self._lock:
+            self._active.pop(profile.thread_id, None)
+            entry = (profile.duration, profile.number, profile)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+                self._changed = True
+            elif self._slowest and entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+                self._changed = True
+
+    def _sample(self):
+        """ runs while there are profiled requests in flight """
+        while True:
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    self._sampler = None
+                    return
+            frames = sys._current_frames()
+            for profile in active:
+                frame = frames.get(profile.thread_id)
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                names.reverse()
+                if profile.current_query:
+                    names.append('SQL ' + profile.current_query.replace(';', ','))
+                profile.stacks[';'.join(names)] += 1
+            time.sleep(self.interval)
+
+    # reading the results
+
+    def _local_profiles(self):
+        with self._lock:
+            kept = [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+        worker = {'worker': self.worker, 'pid': os.getpid(), 'enabled': self.enabled,
+                  'sample_rate': self.sample_rate, 'keep': self.keep, 'updated': time.time(), 'kept': len(kept)}
+        return [worker], [dict(profile.summary(), worker=self.worker, stacks=profile.stacks) for profile in kept]
+
+    def _shared_profiles(self):
+        self.sync(force=True)
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT log_value FROM logs WHERE log_name LIKE %s", (WORKER_LOG_PREFIX + '%', ))
+            workers = [json.loads(row[0]) for row in cur.fetchall()]
+        finally:
+            db.close()
+        profiles = []
+        for worker in workers:
+            worker['kept'] = len(worker['profiles'])
+            profiles.extend(worker.pop('profiles'))
+        profiles.sort(key=lambda profile: profile['duration_ms'], reverse=True)
+        return workers, profiles
+
+    def _profiles(self):
+        """ the state of each worker and the kept requests of all of them, slowest first.
+        only this worker's if they are not shared or the db can not be read """
+        if self._get_connection is not None:
+            try:
+                return self._shared_profiles()
+            except Exception as e:
+                print(f'can not read the profiles of the other workers; {e}')
+        return self._local_profiles()
+
+    def status(self):
+        workers, profiles = self._profiles()
+        return {'enabled': self.enabled, 'sample_rate': self.sample_rate, 'keep': self.keep,
+                'endpoints': list(self.endpoints), 'worker': self.worker, 'workers': workers,
+                'slowest': [{key: value for key, value in profile.items() if key != 'stacks'}
+                            for profile in profiles[:self.keep]]}
+
+    def collapsed(self, profile_id=None):
+        """ the kept profiles (or only `profile_id`) as collapsed stacks, one
+        `frame;frame;frame count` line per distinct stack """
+        stacks = collections.Counter()
+        for profile in self._profiles()[1]:
+            if profile_id is None or profile['id'] == profile_id:
+                stacks.update(profile['stacks'])
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
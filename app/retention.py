@@ -0,0 +1,215 @@
+""" keeps PROCESSED_SMS small: the table is partitioned by month and whole
+months older than SMS_RETENTION_DAYS are written to gzipped csv files in
+SMS_ARCHIVE_FOLDER and then dropped with ALTER TABLE ... DROP PARTITION.
+the sms log api reads the archives when asked to, after the table runs out.
+
+run it from cron in the app folder, e.g. once a day:
+    python retention.py
+the first run partitions an existing table, which rewrites it once """
+import csv
+import datetime
+import gzip
+import os
+import re
+import sys
+
+import config
+import MySQLdb
+import MySQLdb.cursors
+
+TABLE = 'PROCESSED_SMS'
+COLUMNS = ('id', 'status', 'sender', 'message', 'answer', 'date')
+PARTITION_RE = re.compile(r'p(\d{4})(\d{2})$')
+ARCHIVE_RE = re.compile(TABLE + r'-(\d{6})\.csv\.gz$')
+MONTHS_AHEAD = 2
+
+
+def get_database_connection():
+    """connects to the MySQL database and returns the connection"""
+    return MySQLdb.connect(host=config.MYSQL_HOST,
+                           user=config.MYSQL_USERNAME,
+                           passwd=config.MYSQL_PASSWORD,
+                           db=config.MYSQL_DB_NAME,
+                           charset='utf8')
+
+
+def _next_month(month):
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def _partition(month):
+    """ the partition holding the rows of `month` (the first day of a month) """
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{_next_month(month):%Y-%m-%d}'))"
+
+
+def partition_clause(first_month, last_month):
+    """ PARTITION BY for monthly partitions from first_month to last_month, plus a
+    catch-all pfuture for rows after them """
+    partitions = []
+    month = first_month
+    while month <= last_month:
+        partitions.append(_partition(month))
+        month = _next_month(month)
+    partitions.append('PARTITION pfuture VALUES LESS THAN MAXVALUE')
+    return 'PARTITION BY RANGE (TO_DAYS(date)) (\n    ' + ',\n    '.join(partitions) + ')'
+
+
+def _this_month():
+    return datetime.date.today().replace(day=1)
+
+
+def _months_ahead(month, count):
+    for _ in range(count):
+        month = _next_month(month)
+    return month
+
+
+def current_partition_clause():
+    """ partition_clause() for a new table: this month and the next MONTHS_AHEAD """
+    return partition_clause(_this_month(), _months_ahead(_this_month(), MONTHS_AHEAD))
+
+
+def partitions(cur):
+    """ [(name, rows, bytes)] of the table's partitions; empty if it is not partitioned """
+    cur.execute("""SELECT PARTITION_NAME, TABLE_ROWS, DATA_LENGTH + INDEX_LENGTH
+                   FROM information_schema.PARTITIONS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+                   ORDER BY PARTITION_ORDINAL_POSITION""", (TABLE, ))
+    return list(cur.fetchall())
+
+
+def partition_table(db):
+    """ partitions a table created before partitioning. the primary key becomes
+    (id, date), since MySQL wants the partitioning column in every unique key """
+    cur = db.cursor()
+    cur.execute(f"SELECT MIN(date) FROM {TABLE}")
+    oldest = cur.fetchone()[0]
+    first_month = oldest.date().replace(day=1) if oldest else _this_month()
+    print(f'partitioning {TABLE}; this rewrites the table once')
+    cur.execute(f"ALTER TABLE {TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (id, date)")
+    cur.execute(f"ALTER TABLE {TABLE} " + partition_clause(first_month, _months_ahead(_this_month(), MONTHS_AHEAD)))
+    db.commit()
+
+
+def add_partitions(db, months_ahead=MONTHS_AHEAD):
+    """ splits the coming months out of pfuture while it is still empty, which is cheap """
+    cur = db.cursor()
+    existing = {name for name, _, _ in partitions(cur)}
+    month, last = _this_month(), _months_ahead(_this_month(), months_ahead)
+    missing = []
+    while month <= last:
+        if f'p{month:%Y%m}' not in existing:
+            missing.append(_partition(month))
+        month = _next_month(month)
+    if missing:
+        cur.execute(f"""ALTER TABLE {TABLE} REORGANIZE PARTITION pfuture INTO (
+                        {', '.join(missing)}, PARTITION pfuture VALUES LESS THAN MAXVALUE)""")
+        db.commit()
+
+
+def archive_path(archive_folder, month_name):
+    return os.path.join(archive_folder, f'{TABLE}-{month_name}.csv.gz')
+
+
+def archive_partition(db, name, path):
+    """ writes the rows of one partition, newest first, to a gzipped csv file.
+    returns the number of rows written """
+    cur = db.cursor(MySQLdb.cursors.SSCursor)
+    cur.execute(f"SELECT {', '.join(COLUMNS)} FROM {TABLE} PARTITION ({name}) ORDER BY date DESC, id DESC")
+    rows = 0
+    temporary = path + '.tmp'
+    with gzip.open(temporary, 'wt', encoding='utf-8', newline='') as archive:
+        writer = csv.writer(archive)
+        writer.writerow(COLUMNS)
+        for row in cur:
+            writer.writerow(row)
+            rows += 1
+    cur.close()
+    os.replace(temporary, path)
+    return rows
+
+
+def run(max_age_days, archive_folder):
+    """ archives and drops every monthly partition whose rows are all older
+    than max_age_days. returns what was reclaimed """
+    db = get_database_connection()
+    if not partitions(db.cursor()):
+        partition_table(db)
+    add_partitions(db)
+
+    os.makedirs(archive_folder, exist_ok=True)
+    cutoff = datetime.date.today() - datetime.timedelta(days=max_age_days)
+    report = {'partitions': [], 'rows': 0, 'bytes_reclaimed': 0, 'archive_bytes': 0}
+    for name, _, size in partitions(db.cursor()):
+        match = PARTITION_RE.match(name)
+        if not match:
+            continue
+        month = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+        if _next_month(month) > cutoff:
+            continue
+        path = archive_path(archive_folder, f'{month:%Y%m}')
+        rows = archive_partition(db, name, path)
+        db.cursor().execute(f"ALTER TABLE {TABLE} DROP PARTITION {name}")
+        db.commit()
+        report['partitions'].append(name)
+        report['rows'] += rows
+        report['bytes_reclaimed'] += int(size or 0)
+        report['archive_bytes'] += os.path.getsize(path)
+    db.close()
+    return report
+
+
+def has_archives(archive_folder):
+    """ whether there is any archived month, without opening one """
+    if not archive_folder or not os.path.isdir(archive_folder):
+        return False
+    return any(ARCHIVE_RE.match(name) for name in os.listdir(archive_folder))
+
+
+def iter_archived(archive_folder, before=None, since=None, status=None, sender=None):
+    """ yields archived sms as (id, status, sender, message, answer, date text)
+    tuples, newest first. only rows older than the `before` (date text, id) cursor
+    and not older than the `since` date text are read """
+    if not archive_folder or not os.path.isdir(archive_folder):
+        return
+    months = sorted((name for name in os.listdir(archive_folder) if ARCHIVE_RE.match(name)), reverse=True)
+    for name in months:
+        month = ARCHIVE_RE.match(name).group(1)
+        if before and month > before[0][:7].replace('-', ''):
+            continue
+        if since and month < since[:7].replace('-', ''):
+            return
+        with gzip.open(os.path.join(archive_folder, name), 'rt', encoding='utf-8', newline='') as archive:
+            reader = csv.reader(archive)
+            next(reader, None)
+            for sms_id, row_status, row_sender, message, answer, date in reader:
+                if before and (date, int(sms_id)) >= (before[0], before[1]):
+                    continue
+                if since and date < since:
+                    return
+                if status and row_status != status:
+                    continue
+                if sender and not row_sender.startswith(sender):
+                    continue
+                yield int(sms_id), row_status, row_sender, message, answer, date
+
+
+def read_archived(archive_folder, limit, before=None, status=None, sender=None):
+    """ reads up to `limit` archived sms, newest first, like the sms log api does
+    from the table. `before` is a (date text, id) cursor; only older rows are returned """
+    found = []
+    for sms_id, row_status, row_sender, message, answer, date in iter_archived(
+            archive_folder, before, None, status, sender):
+        found.append({'id': sms_id, 'status': row_status, 'sender': row_sender,
+                      'message': message, 'answer': answer, 'date': date})
+        if len(found) >= limit:
+            break
+    return found
+
+
+if __name__ == '__main__':
+    report = run(getattr(config, 'SMS_RETENTION_DAYS', 365), getattr(config, 'SMS_ARCHIVE_FOLDER', 'archive'))
+    print(f"archived {report['rows']} rows from {len(report['partitions'])} partitions "
+          f"({', '.join(report['partitions']) or 'none'}); "
+          f"reclaimed {report['bytes_reclaimed']} bytes, archives are {report['archive_bytes']} bytes")
+    sys.exit()
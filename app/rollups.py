@@ -0,0 +1,79 @@
+""" hourly and daily message counts by status, kept next to PROCESSED_SMS.
+SmsLogWriter adds every flushed batch to them right after writing it, so the
+dashboard charts read a few hundred rows instead of scanning the sms log.
+a batch whose rollup update fails is still logged; backfill() recounts it """
+import collections
+import datetime
+
+HOURLY_TABLE = 'SMS_ROLLUP_HOURLY'
+DAILY_TABLE = 'SMS_ROLLUP_DAILY'
+PERIODS = {'hourly': HOURLY_TABLE, 'daily': DAILY_TABLE}
+
+# how the two tables cut a 'YYYY-mm-dd HH:MM:SS' date into buckets
+BUCKET_FORMATS = {HOURLY_TABLE: '%Y-%m-%d %H:00:00', DAILY_TABLE: '%Y-%m-%d'}
+
+
+def create_tables(cur):
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {HOURLY_TABLE} (
+        bucket DATETIME,
+        status ENUM('OK', 'FAILURE', 'DOUBLE', 'NOT-FOUND'),
+        count BIGINT NOT NULL,
+        PRIMARY KEY(bucket, status));""")
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {DAILY_TABLE} (
+        bucket DATE,
+        status ENUM('OK', 'FAILURE', 'DOUBLE', 'NOT-FOUND'),
+        count BIGINT NOT NULL,
+        PRIMARY KEY(bucket, status));""")
+
+
+def _date_text(date):
+    if isinstance(date, (datetime.date, datetime.datetime)):
+        return date.strftime('%Y-%m-%d %H:%M:%S')
+    return str(date)
+
+
+def add_records(cur, records):
+    """ adds (status, sender, message, answer, date) records to both rollups.
+    does not commit; the caller commits it after the records are committed """
+    hourly = collections.Counter()
+    daily = collections.Counter()
+    for status, _, _, _, date in records:
+        date = _date_text(date)
+        hourly[(date[:13] + ':00:00', status)] += 1
+        daily[(date[:10], status)] += 1
+    for table, counts in ((HOURLY_TABLE, hourly), (DAILY_TABLE, daily)):
+        if counts:
+            cur.executemany(f"""INSERT INTO {table} (bucket, status, count) VALUES (%s, %s, %s)
+                                ON DUPLICATE KEY UPDATE count = count + VALUES(count)""",
+                            [(bucket, status, count) for (bucket, status), count in counts.items()])
+
+
+def backfill(db, since=None):
+    """ rebuilds the rollups from PROCESSED_SMS (from `since` on, or all of it).
+    messages logged while it runs may be counted twice in their bucket; run it
+    once after upgrading or when the rollups look wrong """
+    cur = db.cursor()
+    where, params = ('WHERE date >= %s', (since, )) if since else ('', ())
+    for table, bucket_format in BUCKET_FORMATS.items():
+        cur.execute(f"""REPLACE INTO {table} (bucket, status, count)
+                        SELECT DATE_FORMAT(date, '{bucket_format.replace('%', '%%')}'), status, COUNT(*)
+                        FROM PROCESSED_SMS {where}
+                        GROUP BY 1, status""", params)
+    db.commit()
+
+
+def read(cur, period, since):
+    """ returns {'labels': [bucket, ...], 'series': {status: [count, ...]}} for
+    the buckets from `since` on; buckets without messages are left out """
+    cur.execute(f"SELECT bucket, status, count FROM {PERIODS[period]} WHERE bucket >= %s ORDER BY bucket",
+                (since, ))
+    labels = []
+    counts = {}
+    for bucket, status, count in cur.fetchall():
+        label = str(bucket)
+        if not labels or labels[-1] != label:
+            labels.append(label)
+        counts[(label, status)] = int(count)
+    series = {status: [counts.get((label, status), 0) for label in labels]
+              for status in ('OK', 'FAILURE', 'DOUBLE', 'NOT-FOUND')}
+    return {'labels': labels, 'series': series}
@@ -0,0 +1,325 @@
+import bisect
+import json
+import re
+import threading
+import time
+
+import metrics
+
+# the import process (import_db.py) writes this key into the logs table when a
+# new catalog is fully loaded and checked. any change means we have to reload.
+GENERATION_LOG_NAME = 'generation'
+# and the letter prefixes in which db_check found overlapping ranges
+OVERLAPPING_LOG_NAME = 'overlapping_prefixes'
+
+SERIAL_COLUMNS = "id, ref, description, start_serial, end_serial, date, text1, text2"
+SERIAL_NUMBER_RE = re.compile(r'([A-Z]*)0*(\d*)$')
+MAX_SERIAL_NUMBER = 2 ** 63 - 1
+LOOKUP_BATCH = 100
+
+
+def read_generation(cur):
+    """ returns the generation id published by the last finished import or None """
+    try:
+        cur.execute("SELECT log_value FROM logs WHERE log_name = %s", (GENERATION_LOG_NAME, ))
+        row = cur.fetchone()
+    except Exception:
+        return None
+    return row[0] if row else None
+
+
+def serial_prefix(serial):
+    """ gets AA0000000000000000000000000090 and returns AA """
+    return re.match('[A-Z]*', serial).group()
+
+
+class _Partition:
+    """ all ranges of one letter prefix, cut into elementary segments.
+    the ends of the ranges split the serials into segments covered by the same
+    ranges; for each segment up to two of its covering rows are kept (two is
+    enough to answer DOUBLE), so a lookup is one bisect however the ranges nest.
+    a segment starts at a key (serial, 0), at a start serial, or (serial, 1), right
+    after an end serial; a serial s is looked up as (s, 0) """
+
+    def __init__(self, rows):
+        events = []
+        for number, row in enumerate(rows):
+            if row[3] <= row[4]:
+                events.append(((row[3], 0), number))
+                events.append(((row[4], 1), number))
+        events.sort(key=lambda event: event[0])
+
+        self.keys = []
+        self.covering = []
+        active = {}
+        for i, (key, number) in enumerate(events):
+            if key[1] == 0:
+                active[number] = rows[number]
+            else:
+                del active[number]
+            if i + 1 < len(events) and events[i + 1][0] == key:
+                continue
+            covering = []
+            for row in active.values():
+                covering.append(row)
+                if len(covering) == 2:
+                    break
+            self.keys.append(key)
+            self.covering.append(tuple(covering))
+
+    def find(self, serial, limit):
+        i = bisect.bisect_right(self.keys, (serial, 0)) - 1
+        return list(self.covering[i][:limit]) if i >= 0 else []
+
+
+class Snapshot:
+    """ an immutable, in-memory copy of the serials and invalids tables """
+
+    def __init__(self, serial_rows, invalid_serials, generation=None):
+        self.generation = generation
+        self.invalids = frozenset(invalid_serials)
+        self.size = 0
+        # rows whose start and end have different letters can not be partitioned;
+        # db_check reports them, we just compare them the way MySQL does
+        self.mixed = []
+        grouped = {}
+        for row in serial_rows:
+            start_serial, end_serial = row[3], row[4]
+            if start_serial is None or end_serial is None:
+                continue
+            self.size += 1
+            prefix = serial_prefix(start_serial)
+            if prefix != serial_prefix(end_serial):
+                self.mixed.append(row)
+            else:
+                grouped.setdefault(prefix, []).append(row)
+        self.partitions = {prefix: _Partition(rows) for prefix, rows in grouped.items()}
+
+    def lookup(self, serial):
+        """ gets a normalized serial and returns (status, row) like check_serial does.
+        row is only set when status is OK """
+        if serial in self.invalids:
+            return 'FAILURE', None
+
+        matches = []
+        partition = self.partitions.get(serial_prefix(serial))
+        if partition is not None:
+            matches = partition.find(serial, 2)
+        for row in self.mixed:
+            if len(matches) > 1:
+                break
+            if row[3] <= serial <= row[4]:
+                matches.append(row)
+
+        if len(matches) > 1:
+            return 'DOUBLE', None
+        elif len(matches) == 1:
+            return 'OK', matches[0]
+        return 'NOT-FOUND', None
+
+
+class SerialIndex:
+    """ serves serial lookups from memory and reloads the snapshot when a new
+    import generation shows up in the logs table. lookups never wait for a
+    reload unless there is nothing loaded yet """
+
+    def __init__(self, get_connection, refresh_interval=5):
+        self._get_connection = get_connection
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        snapshot = self._snapshot
+        return snapshot.generation if snapshot else None
+
+    def load(self, force=False):
+        """ reads the tables if the generation changed (or force) and swaps the
+        new snapshot in. returns True if a new snapshot was loaded """
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            generation = read_generation(cur)
+            current = self._snapshot
+            # no generation means there is no finished import or one is running
+            # right now; keep serving what we have
+            if not force and current is not None and generation in (None, current.generation):
+                return False
+            with metrics.stage('index_reload'):
+                cur.execute(f"SELECT {SERIAL_COLUMNS} FROM serials")
+                serial_rows = list(cur.fetchall())
+                cur.execute("SELECT invalid_serial FROM invalids")
+                invalid_serials = [row[0] for row in cur.fetchall()]
+                snapshot = Snapshot(serial_rows, invalid_serials, generation)
+        finally:
+            db.close()
+        self._snapshot = snapshot
+        return True
+
+    def _current(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._last_check < self.refresh_interval:
+            return snapshot
+
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.load(force=True)
+                    self._last_check = time.monotonic()
+                return self._snapshot
+
+        # someone else is already checking; the current snapshot is good enough
+        if not self._lock.acquire(blocking=False):
+            return snapshot
+        try:
+            self._last_check = now
+            self.load()
+        except Exception:
+            pass  # db is unreachable; keep answering from the old snapshot
+        finally:
+            self._lock.release()
+        return self._snapshot
+
+    def snapshot(self, serials=()):
+        """ returns the current snapshot; use it to answer many lookups from one generation.
+        `serials` is for DbSerialLookup, which reads them ahead """
+        return self._current()
+
+    def lookup(self, serial):
+        """ gets a normalized serial and returns (status, row). see Snapshot.lookup """
+        return self._current().lookup(serial)
+
+
+class DbSerialLookup:
+    """ answers lookups straight from MySQL instead of a memory copy, using the
+    prefix / start_number / end_number columns and their index.
+    where db_check found no overlapping ranges in a prefix, only the range starting
+    closest below the serial can hold it, so an equality on the prefix and a one
+    sided range on start_number read backwards with LIMIT 1 is enough and the cost
+    does not grow with the table. prefixes with overlapping ranges (or all of them,
+    when the import did not record which) get the two sided start_number <= n AND
+    end_number >= n query. the few rows without a prefix (start and end letters
+    differ, or a number too big for a BIGINT) are kept in memory and compared like
+    MySQL compares the serial strings, so the answers are the same as Snapshot's """
+
+    def __init__(self, get_connection, refresh_interval=5):
+        self._get_connection = get_connection
+        self.refresh_interval = refresh_interval
+        self._state = (None, None, [])  # generation, overlapping prefixes or None, rows without prefix
+        self._loaded = False
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._loaded and now - self._last_check < self.refresh_interval:
+            return self._state
+        with self._lock:
+            if self._loaded and now - self._last_check < self.refresh_interval:
+                return self._state
+            db = self._get_connection()
+            try:
+                cur = db.cursor()
+                cur.execute("SELECT log_name, log_value FROM logs WHERE log_name IN (%s, %s)",
+                            (GENERATION_LOG_NAME, OVERLAPPING_LOG_NAME))
+                logs = dict(cur.fetchall())
+                generation = logs.get(GENERATION_LOG_NAME)
+                if not self._loaded or generation != self._state[0]:
+                    overlapping = logs.get(OVERLAPPING_LOG_NAME)
+                    overlapping = frozenset(json.loads(overlapping)) if overlapping is not None else None
+                    cur.execute(f"SELECT {SERIAL_COLUMNS} FROM serials WHERE prefix IS NULL")
+                    unprefixed = [row for row in cur.fetchall() if row[3] is not None and row[4] is not None]
+                    self._state = (generation, overlapping, unprefixed)
+                    self._loaded = True
+            finally:
+                db.close()
+            self._last_check = now
+        return self._state
+
+    @property
+    def generation(self):
+        return self._refresh()[0]
+
+    def snapshot(self, serials=()):
+        """ with normalized `serials` they are all looked up now, with two queries,
+        and the returned object answers them from memory """
+        if not serials:
+            return self
+        return _DbAnswers(self, self._refresh()[0], self._lookup_many(list(dict.fromkeys(serials))))
+
+    @staticmethod
+    def _range_query(prefix, number, overlapping):
+        """ the query (and its parameters) for the prefixed ranges which may hold one
+        serial; rows whose end_number (the last column) is below it are filtered out after """
+        if overlapping is None or prefix in overlapping:
+            return (f"""SELECT %s, {SERIAL_COLUMNS}, end_number FROM serials
+                        WHERE prefix = %s AND start_number <= %s AND end_number >= %s LIMIT 2""",
+                    (prefix, number, number))
+        return (f"""SELECT %s, {SERIAL_COLUMNS}, end_number FROM serials
+                    WHERE prefix = %s AND start_number <= %s ORDER BY start_number DESC LIMIT 1""",
+                (prefix, number))
+
+    def _lookup_many(self, serials):
+        """ {serial: (status, row)} for normalized serials """
+        _, overlapping, unprefixed = self._refresh()
+        found = {serial: [row for row in unprefixed if row[3] <= serial <= row[4]] for serial in serials}
+        numbers = {}
+        for serial in serials:
+            match = SERIAL_NUMBER_RE.match(serial)
+            if match is not None and int(match.group(2) or 0) <= MAX_SERIAL_NUMBER:
+                numbers[serial] = (match.group(1), int(match.group(2) or 0))
+        invalid = set()
+        db = self._get_connection()
+        try:
+            cur = db.cursor()
+            for i in range(0, len(serials), LOOKUP_BATCH):
+                chunk = serials[i:i + LOOKUP_BATCH]
+                cur.execute(f"SELECT invalid_serial FROM invalids WHERE invalid_serial IN "
+                            f"({', '.join(['%s'] * len(chunk))})", chunk)
+                invalid.update(row[0] for row in cur.fetchall())
+
+                queries, params = [], []
+                for serial in chunk:
+                    if serial in numbers:
+                        query, query_params = self._range_query(*numbers[serial], overlapping)
+                        queries.append(f'({query})')
+                        params.extend((serial, ) + query_params)
+                if queries:
+                    cur.execute(' UNION ALL '.join(queries), params)
+                    for row in cur.fetchall():
+                        if row[-1] >= numbers[row[0]][1]:
+                            found[row[0]].append(row[1:-1])
+        finally:
+            db.close()
+
+        answers = {}
+        for serial, matches in found.items():
+            if serial in invalid:
+                answers[serial] = ('FAILURE', None)
+            elif len(matches) > 1:
+                answers[serial] = ('DOUBLE', None)
+            elif len(matches) == 1:
+                answers[serial] = ('OK', matches[0])
+            else:
+                answers[serial] = ('NOT-FOUND', None)
+        return answers
+
+    def lookup(self, serial):
+        """ gets a normalized serial and returns (status, row). see Snapshot.lookup """
+        return self._lookup_many([serial])[serial]
+
+
+class _DbAnswers:
+    """ the answers DbSerialLookup.snapshot() read for a batch of serials """
+
+    def __init__(self, lookups, generation, answers):
+        self._lookups = lookups
+        self.generation = generation
+        self._answers = answers
+
+    def lookup(self, serial):
+        answer = self._answers.get(serial)
+        return answer if answer is not None else self._lookups.lookup(serial)
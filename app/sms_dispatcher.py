@@ -0,0 +1,279 @@
+import collections
+import datetime
+import heapq
+import json
+import queue
+import threading
+import time
+
+import requests
+
+import metrics
+
+KAVENEGAR_URL = 'https://api.kavenegar.com/v1'
+
+
+# the sendarray entry statuses of messages which will not be delivered:
+# failed, undelivered, cancelled, blocked by the receptor, unknown message id
+FAILED_ENTRY_STATUSES = {6, 11, 13, 14, 100}
+
+# what send_batch says about each message
+SENT, RETRY, FAILED = 'SENT', 'RETRY', 'FAILED'
+
+DELIVERY_TABLE = 'SMS_DELIVERY'
+
+
+def create_delivery_table(cur):
+    """ the final status of every outgoing sms: SENT, or FAILED after its last attempt """
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {DELIVERY_TABLE} (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        receptor CHAR(20),
+        status ENUM('SENT', 'FAILED'),
+        info VARCHAR(400),
+        attempts INTEGER,
+        queued DATETIME,
+        done DATETIME,
+        INDEX(done), INDEX(receptor, done), INDEX(status, done))""")
+
+
+class KavenegarTransport:
+    """ sends sms through KaveNegar over one keep-alive http session.
+    a batch of more than one message goes out in a single sendarray call
+    (which needs a sender line number); otherwise send.json is used """
+
+    def __init__(self, api_key, sender=None, timeout=10, base_url=KAVENEGAR_URL):
+        self.url = f'{base_url}/{api_key}/sms'
+        self.sender = sender
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _post(self, method, data):
+        """ returns (SENT, RETRY or FAILED, body, info). only server errors (5xx) are
+        worth retrying; 4xx statuses like an invalid receptor or no credit are not """
+        res = self.session.post(f'{self.url}/{method}.json', data=data, timeout=self.timeout)
+        try:
+            body = res.json()
+            status = body['return']['status']
+            info = body['return'].get('message', '')
+        except (ValueError, KeyError, TypeError):
+            body, status, info = {}, res.status_code, res.text[:200]
+        if status == 200:
+            outcome = SENT
+        elif isinstance(status, int) and status >= 500:
+            outcome = RETRY
+        else:
+            outcome = FAILED
+        return outcome, body, f'{status} {info}'
+
+    def send_batch(self, items):
+        """ gets a list of (receptor, message) and returns one (outcome, info) per
+        item, where outcome is SENT, RETRY or FAILED. may raise on network errors;
+        then the whole batch is retried """
+        if len(items) > 1 and self.sender:
+            # sendarray takes json arrays of the same length
+            data = {'receptor': json.dumps([receptor for receptor, _ in items]),
+                    'message': json.dumps([message for _, message in items], ensure_ascii=False),
+                    'sender': json.dumps([self.sender] * len(items))}
+            outcome, body, info = self._post('sendarray', data)
+            if outcome != SENT:
+                return [(outcome, info)] * len(items)
+            entries = body.get('entries') or []
+            results = []
+            for i in range(len(items)):
+                if i >= len(entries):
+                    # it may have been sent anyway; a retry could send it twice
+                    results.append((FAILED, 'no entry in the sendarray answer'))
+                    continue
+                entry = entries[i]
+                info = f"{entry.get('messageid', '')} {entry.get('statustext', '')}".strip()
+                results.append((FAILED if entry.get('status') in FAILED_ENTRY_STATUSES else SENT, info))
+            return results
+
+        results = []
+        for receptor, message in items:
+            data = {'message': message, 'receptor': receptor}
+            if self.sender:
+                data['sender'] = self.sender
+            try:
+                outcome, _, info = self._post('send', data)
+            except requests.RequestException as e:
+                outcome, info = RETRY, str(e)
+            results.append((outcome, info))
+        return results
+
+
+class SmsDispatcher:
+    """ a background sender for outgoing sms.
+    send() only puts the message in a queue. a worker thread waits
+    `batch_window` seconds for more messages, sends them together and
+    retries the ones the transport says are worth it with exponential backoff.
+    with get_connection the final status of each message is written into
+    SMS_DELIVERY; the last `keep_results` of them are also kept in memory """
+
+    def __init__(self, transport, batch_window=0.2, max_batch=100, max_retries=3,
+                 backoff=1, max_queue=10000, keep_results=200, get_connection=None):
+        self.transport = transport
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue(max_queue)
+        self._retries = []  # heap of (due time, sequence, item)
+        self._sequence = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._get_connection = get_connection
+        # the counters are updated from request threads and the worker
+        self._stats_lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.results = collections.deque(maxlen=keep_results)
+
+    def start(self):
+        """ starts the worker thread; does nothing if it is already running """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='sms-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """ sends what is queued and stops. retries which are not due yet are
+        not sent; they are recorded as failed """
+        self._stopping = True
+        thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def send(self, receptor, message):
+        """ queues one sms. returns False if the queue is full and the sms is dropped """
+        self.start()
+        try:
+            self._queue.put_nowait({'receptor': receptor, 'message': message, 'attempt': 0,
+                                    'queued': time.time()})
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('queued')
+        return True
+
+    def _count(self, name, count=1):
+        with self._stats_lock:
+            self.counters[name] += count
+
+    def _due_retries(self, now):
+        due = []
+        while self._retries and self._retries[0][0] <= now and len(due) < self.max_batch:
+            due.append(heapq.heappop(self._retries)[2])
+        return due
+
+    def _collect(self):
+        """ waits for the first message and then gathers more for batch_window seconds """
+        batch = self._due_retries(time.monotonic())
+        if not batch:
+            wait = self._retries[0][0] - time.monotonic() if self._retries else None
+            try:
+                item = self._queue.get(timeout=max(wait, 0) if wait is not None else None)
+            except queue.Empty:
+                return self._due_retries(time.monotonic())
+            if item is None:
+                return None
+            batch.append(item)
+
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopping = True
+                break
+            batch.append(item)
+        return batch
+
+    def _deliver(self, batch):
+        items = [(item['receptor'], item['message']) for item in batch]
+        try:
+            with metrics.stage('sms_send_batch'):
+                results = self.transport.send_batch(items)
+        except Exception as e:
+            results = [(RETRY, str(e))] * len(batch)
+        self._count('batches')
+
+        finished = []
+        for item, (outcome, info) in zip(batch, results):
+            item['attempt'] += 1
+            if outcome == SENT:
+                self._count('sent')
+                finished.append(self._result(item, SENT, info))
+            elif outcome == RETRY and item['attempt'] <= self.max_retries and not self._stopping:
+                self._count('retried')
+                due = time.monotonic() + self.backoff * 2 ** (item['attempt'] - 1)
+                self._sequence += 1
+                heapq.heappush(self._retries, (due, self._sequence, item))
+            else:
+                self._count('failed')
+                finished.append(self._result(item, FAILED, info))
+        if finished:
+            with self._stats_lock:
+                self.results.extend(finished)
+            self._store(finished)
+
+    @staticmethod
+    def _result(item, status, info):
+        return {'receptor': item['receptor'], 'status': status, 'info': info,
+                'attempts': item['attempt'], 'queued': item['queued'], 'done': time.time()}
+
+    def _store(self, results):
+        """ writes the final statuses into SMS_DELIVERY. if the db fails they stay only in memory """
+        if self._get_connection is None:
+            return
+        rows = [(result['receptor'], result['status'], str(result['info'])[:400], result['attempts'],
+                 datetime.datetime.fromtimestamp(result['queued']), datetime.datetime.fromtimestamp(result['done']))
+                for result in results]
+        try:
+            db = self._get_connection()
+            try:
+                db.cursor().executemany(
+                    f"""INSERT INTO {DELIVERY_TABLE} (receptor, status, info, attempts, queued, done)
+                        VALUES (%s, %s, %s, %s, %s, %s)""", rows)
+                db.commit()
+            finally:
+                db.close()
+        except Exception as e:
+            print(f'can not write {len(rows)} sms delivery results; {e}')
+            self._count('store_errors')
+        else:
+            self._count('stored', len(rows))
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            if batch:
+                self._deliver(batch)
+            if self._stopping and self._queue.empty():
+                break
+        # retries which were not due yet are not sent, but their last status is kept
+        if self._retries:
+            dropped = [self._result(item, FAILED, 'not retried, the app stopped') for _, _, item in self._retries]
+            self._retries = []
+            self._count('failed', len(dropped))
+            with self._stats_lock:
+                self.results.extend(dropped)
+            self._store(dropped)
+
+    def stats(self):
+        with self._stats_lock:
+            counters, results = dict(self.counters), list(self.results)[-20:]
+        return {'queue': self._queue.qsize(),
+                'retry_queue': len(self._retries),
+                'counters': counters,
+                'last_results': results}
@@ -0,0 +1,145 @@
+import collections
+import json
+import os
+import threading
+
+import metrics
+import rollups
+
+INSERT_SMS = "INSERT INTO PROCESSED_SMS (status, sender, message, answer, date) VALUES (%s, %s, %s, %s, %s)"
+
+
+class SmsLogWriter:
+    """ write-behind logger for PROCESSED_SMS.
+    log() only appends to an in-memory buffer. a background thread writes the
+    buffer with one multi-row insert when `batch_size` records are waiting or
+    every `flush_interval` seconds. at most `max_buffer` records are kept in
+    memory; if MySQL is down (or the buffer is full) records go to `spill_path`
+    (when set) and are written to the db on a later successful flush.
+    every flush also updates the hourly and daily rollups (rollups.py), in a
+    transaction of its own """
+
+    def __init__(self, get_connection, batch_size=100, flush_interval=1, max_buffer=10000, spill_path=None):
+        self._get_connection = get_connection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.counters = collections.Counter()
+
+    def start(self):
+        """ starts the writer thread; does nothing if it is already running """
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='sms-log-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """ writes everything which is buffered and stops the thread """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def log(self, status, sender, message, answer, date):
+        self.start()
+        record = (status, sender, message, answer, date)
+        with self._cond:
+            if len(self._buffer) < self.max_buffer:
+                self._buffer.append(record)
+                self.counters['buffered'] += 1
+                if len(self._buffer) >= self.batch_size:
+                    self._cond.notify()
+                return
+        self._spill([record])
+
+    def _take(self):
+        with self._cond:
+            if len(self._buffer) < self.batch_size and not self._stopping:
+                self._cond.wait(self.flush_interval)
+            records = []
+            while self._buffer and len(records) < self.batch_size:
+                records.append(self._buffer.popleft())
+            return records
+
+    def _run(self):
+        while True:
+            records = self._take()
+            if records:
+                self._write(records)
+            with self._cond:
+                if self._stopping and not self._buffer:
+                    break
+
+    def _insert(self, records):
+        with metrics.stage('sms_log_flush'):
+            db = self._get_connection()
+            try:
+                cur = db.cursor()
+                cur.executemany(INSERT_SMS, records)
+                db.commit()
+                # the rollups are only counts; never lose log rows because of them
+                try:
+                    rollups.add_records(cur, records)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    self.counters['rollup_errors'] += len(records)
+            finally:
+                db.close()
+
+    def _write(self, records):
+        try:
+            self._insert(records)
+        except Exception:
+            self.counters['failed_flushes'] += 1
+            self._spill(records)
+            return
+        self.counters['written'] += len(records)
+        self.counters['flushes'] += 1
+        self._replay_spilled()
+
+    def _spill(self, records):
+        if not self.spill_path:
+            self.counters['dropped'] += len(records)
+            return
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as spill:
+                for record in records:
+                    spill.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.counters['spilled'] += len(records)
+
+    def _replay_spilled(self):
+        """ db is reachable again; moves what was spilled into it """
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        replay_path = self.spill_path + '.replay'
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+        with open(replay_path, encoding='utf-8') as replay:
+            records = [tuple(json.loads(line)) for line in replay if line.strip()]
+        try:
+            for i in range(0, len(records), self.batch_size):
+                self._insert(records[i:i + self.batch_size])
+                self.counters['replayed'] += len(records[i:i + self.batch_size])
+        except Exception:
+            # try again after the next successful flush; keep what is not written yet
+            with open(replay_path, 'w', encoding='utf-8') as replay:
+                for record in records[i:]:
+                    replay.write(json.dumps(record, ensure_ascii=False) + '\n')
+            return
+        os.remove(replay_path)
+
+    def stats(self):
+        with self._cond:
+            buffered = len(self._buffer)
+        return {'buffer': buffered, 'counters': dict(self.counters)}
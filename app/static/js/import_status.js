@@ -0,0 +1,52 @@
+// Polls /import_status and shows the progress of the running and queued imports
+(function($) {
+    "use strict";
+
+    function describe(job) {
+        var progress = job.progress;
+        var text = job.filename + ": " + progress.phase;
+        if (progress.total) {
+            text += " " + progress.done + " / " + progress.total;
+        } else if (progress.done) {
+            text += " " + progress.done;
+        }
+        if (!progress.total && progress.read_percent !== null && progress.read_percent !== undefined) {
+            text += " (" + progress.read_percent + "% of the file read)";
+        }
+        if (progress.rows_per_sec) {
+            text += ", " + progress.rows_per_sec + " rows/sec";
+        }
+        if (progress.eta_seconds !== null) {
+            text += ", about " + Math.ceil(progress.eta_seconds) + " seconds left";
+        }
+        return text;
+    }
+
+    function cancelButton(job) {
+        return $("<button class='btn btn-sm btn-outline-danger ml-2' type='button'>Cancel</button>")
+            .on("click", function() {
+                $.post("/import/" + job.id + "/cancel", refresh);
+            });
+    }
+
+    function refresh() {
+        $.getJSON("/import_status", function(status) {
+            var box = $("#importStatus").empty();
+            if (status.current) {
+                box.append($("<div>").text(describe(status.current)).append(cancelButton(status.current)));
+            } else {
+                box.append($("<div>").text("No import is running"));
+            }
+            $.each(status.queued, function(_, job) {
+                box.append($("<div class='text-muted'>").text(job.filename + ": queued").append(cancelButton(job)));
+            });
+            $.each(status.history.slice(0, 3), function(_, job) {
+                var text = job.filename + ": " + job.state + (job.error ? " (" + job.error + ")" : "");
+                box.append($("<div class='small text-muted'>").text(text));
+            });
+        });
+    }
+
+    refresh();
+    setInterval(refresh, 2000);
+})(jQuery);
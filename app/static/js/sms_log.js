@@ -0,0 +1,52 @@
+// Loads the SMS History table page by page from /sms_log
+(function($) {
+    "use strict";
+
+    var nextCursor = null;
+    var nextArchived = false;
+
+    function addRows(smss) {
+        var rows = $("#smsLogRows");
+        $.each(smss, function(_, sms) {
+            var row = $("<tr>");
+            row.append($("<td>").text(sms.status));
+            row.append($("<td>").text(sms.sender));
+            row.append($("<td>").css({"direction": "rtl", "text-align": "center"}).text(sms.message));
+            row.append($("<td>").css({"direction": "rtl", "text-align": "right"}).text(sms.answer));
+            row.append($("<td>").text(sms.date));
+            rows.append(row);
+        });
+    }
+
+    function load(reset) {
+        var params = $("#smsLogFilter").serializeArray().filter(function(field) {
+            return field.value !== "";
+        });
+        if (!reset && nextCursor) {
+            params.push({name: "cursor", value: nextCursor});
+        }
+        if (!reset && nextArchived) {
+            // the table ran out; older messages are only read from the archives on request
+            params.push({name: "archived", value: "1"});
+        }
+        $.getJSON("/sms_log", $.param(params), function(page) {
+            if (reset) {
+                $("#smsLogRows").empty();
+            }
+            addRows(page.smss);
+            nextCursor = page.next_cursor;
+            nextArchived = page.next_archived;
+            $("#smsLogMore").toggle(nextCursor !== null)
+                .text(nextArchived ? "Load archived" : "Load more");
+        });
+    }
+
+    $("#smsLogFilter").on("submit", function(e) {
+        e.preventDefault();
+        load(true);
+    });
+    $("#smsLogMore").on("click", function() {
+        load(false);
+    });
+    load(true);
+})(jQuery);
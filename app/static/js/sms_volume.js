@@ -0,0 +1,52 @@
+// Draws the dashboard charts from the sms rollups served by /sms_volume
+(function($) {
+    "use strict";
+
+    Chart.defaults.global.defaultFontFamily = '-apple-system,system-ui,BlinkMacSystemFont,"Segoe UI",Roboto,"Helvetica Neue",Arial,sans-serif';
+    Chart.defaults.global.defaultFontColor = '#292b2c';
+
+    // the same colors as the status cards above the charts
+    var COLORS = {
+        "OK": "rgba(40,167,69,1)",
+        "DOUBLE": "rgba(0,123,255,1)",
+        "FAILURE": "rgba(255,193,7,1)",
+        "NOT-FOUND": "rgba(220,53,69,1)"
+    };
+
+    function datasets(volume, type) {
+        return Object.keys(COLORS).map(function(status) {
+            return {
+                label: status,
+                data: volume.series[status],
+                backgroundColor: type === "line" ? COLORS[status].replace(",1)", ",0.2)") : COLORS[status],
+                borderColor: COLORS[status],
+                lineTension: 0.3,
+                pointRadius: 2
+            };
+        });
+    }
+
+    function draw(canvasId, period, type) {
+        var canvas = document.getElementById(canvasId);
+        if (!canvas) {
+            return;
+        }
+        $.getJSON("/sms_volume", {period: period}, function(volume) {
+            new Chart(canvas, {
+                type: type,
+                data: {labels: volume.labels, datasets: datasets(volume, type)},
+                options: {
+                    scales: {
+                        xAxes: [{stacked: true, gridLines: {display: false}, ticks: {maxTicksLimit: 12}}],
+                        yAxes: [{stacked: true, ticks: {min: 0, maxTicksLimit: 5}}]
+                    }
+                }
+            });
+        });
+    }
+
+    $(function() {
+        draw("smsHourlyChart", "hourly", "line");
+        draw("smsDailyChart", "daily", "bar");
+    });
+})(jQuery);
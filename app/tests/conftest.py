@@ -0,0 +1,20 @@
+""" the app modules import each other by their bare names from the app folder,
+so that folder goes on sys.path. without a config.py the sample one is used """
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_FOLDER)
+
+try:
+    import config
+    if not hasattr(config, 'MYSQL_HOST'):
+        raise ImportError('config is not the app config')
+except ImportError:
+    sample = os.path.join(APP_FOLDER, 'config.py.sample')
+    loader = importlib.machinery.SourceFileLoader('config', sample)
+    config = importlib.util.module_from_spec(importlib.util.spec_from_loader('config', loader))
+    loader.exec_module(config)
+    sys.modules['config'] = config
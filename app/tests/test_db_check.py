@@ -0,0 +1,88 @@
+import random
+
+import import_db
+from import_db import find_collisions
+
+
+def serial(prefix, number):
+    return prefix + str(number).rjust(30 - len(prefix), '0')
+
+
+def pairwise(ranges, invalids):
+    """ the old db_check: every pair of ranges and every invalid against every range """
+    collisions = set()
+    for i, (id1, start1, end1) in enumerate(ranges):
+        for id2, start2, end2 in ranges[i + 1:]:
+            if start1 <= end2 and start2 <= end1:
+                collisions.add(frozenset((id1, id2)))
+    inside = {(serial, id_row) for serial in invalids for id_row, start, end in ranges if start <= serial <= end}
+    return collisions, inside
+
+
+def sweep(ranges, invalids):
+    collisions, inside = set(), set()
+    for kind, first, second in find_collisions(ranges, invalids):
+        if kind == 'collision':
+            collisions.add(frozenset((first, second)))
+        else:
+            inside.add((first, second))
+    return collisions, inside
+
+
+def test_find_collisions_matches_the_pairwise_check():
+    rng = random.Random(0)
+    for _ in range(200):
+        ranges = []
+        for id_row in range(rng.randint(0, 40)):
+            start = rng.randint(0, 300)
+            ranges.append((id_row, start, start + rng.randint(0, 40)))
+        invalids = {rng.randint(0, 350) for _ in range(rng.randint(0, 20))}
+        assert sweep(ranges, invalids) == pairwise(ranges, invalids)
+
+
+def test_find_collisions_reports_each_pair_once():
+    ranges = [(1, 10, 20), (2, 20, 30), (3, 15, 16), (4, 31, 40)]
+    problems = list(find_collisions(ranges, [20, 35, 50]))
+    collisions = [frozenset(problem[1:]) for problem in problems if problem[0] == 'collision']
+    assert sorted(collisions, key=sorted) == [frozenset((1, 2)), frozenset((1, 3))]
+    assert sorted(problem[1:] for problem in problems if problem[0] == 'invalid') == [(20, 1), (20, 2), (35, 4)]
+
+
+class FakeDb:
+    """ answers the queries of db_check() from lists and keeps the db_check log """
+
+    def __init__(self, serials, invalids):
+        self.tables = {'serials': serials, 'invalids': [(serial, ) for serial in invalids]}
+        self.log = None
+        self.rows = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=()):
+        if query.startswith('SELECT'):
+            self.rows = self.tables[query.split()[-1]]
+        elif 'CONCAT' in query:
+            self.log += args[0]
+        elif query.startswith(('INSERT', 'UPDATE')):
+            self.log = args[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_delta_db_check_does_not_count_its_note(monkeypatch):
+    serials = [(1, serial('AA', 1), serial('AA', 9)), (2, serial('AA', 5), serial('AA', 6)),
+               (3, serial('B', 1), serial('B', 2))]
+    db = FakeDb(serials, [serial('B', 2)])
+    monkeypatch.setattr(import_db, 'get_database_connection', lambda: db)
+    assert import_db.db_check(prefixes={'AA'}) == {'AA'}
+    assert db.log.splitlines() == ['checking only the changed prefixes: AA',
+                                   'there is a collision between row ids 1 and 2',
+                                   'DB check finished; 1 problems found']
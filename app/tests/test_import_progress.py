@@ -0,0 +1,55 @@
+import gzip
+
+from openpyxl import Workbook
+
+from import_db import ImportProgress, open_catalog
+
+
+def read_all(*paths):
+    """ reads a catalog and returns its number of rows and the read share after every chunk """
+    rows, shares = 0, []
+    with open_catalog(*paths) as (_, total, read_share, serial_chunks, invalid_chunks):
+        assert total is None
+        for chunks in (serial_chunks, invalid_chunks):
+            for df in chunks:
+                rows += len(df)
+                shares.append(read_share())
+    return rows, shares
+
+
+def test_csv_share_follows_the_bytes_read(tmp_path):
+    serials, invalids = tmp_path / 'serials.csv.gz', tmp_path / 'invalids.csv'
+    with gzip.open(serials, 'wt') as f:
+        f.write('row,ref,description,start,end,date,text1,text2\n')
+        f.writelines(f'{i},r,d,AA{i * 10},AA{i * 10 + 5},2020-01-01,a,b\n' for i in range(30000))
+    invalids.write_text('serial\n' + ''.join(f'BB{i}\n' for i in range(5000)))
+    rows, shares = read_all(str(serials), str(invalids))
+    assert rows == 35000
+    assert shares == sorted(shares) and 0 < shares[0] < 1 and shares[-1] == 1
+
+
+def test_xlsx_share_follows_the_sheets(tmp_path):
+    workbook = Workbook()
+    workbook.active.append(['row', 'ref', 'description', 'start', 'end', 'date', 'text1', 'text2'])
+    for i in range(5000):
+        workbook.active.append([i, 'r', 'd', f'AA{i * 10}', f'AA{i * 10 + 5}', '2020-01-01', 'a', 'b'])
+    invalid_sheet = workbook.create_sheet()
+    invalid_sheet.append(['serial'])
+    for i in range(1000):
+        invalid_sheet.append([f'BB{i}'])
+    path = str(tmp_path / 'catalog.xlsx')
+    workbook.save(path)
+    rows, shares = read_all(path)
+    assert rows == 6000
+    assert shares == sorted(shares) and 0 < shares[0] < 0.5 and shares[-1] > 0.95
+
+
+def test_eta_from_the_read_share():
+    progress = ImportProgress()
+    progress.start_phase('insert', read_share=lambda: 0.25)
+    progress.phase_started -= 10
+    state = progress.as_dict()
+    assert state['read_percent'] == 25.0
+    assert 29 < state['eta_seconds'] < 31
+    progress.start_phase('index')
+    assert progress.as_dict()['eta_seconds'] is None
@@ -0,0 +1,27 @@
+import random
+
+from pandas import Series
+
+from import_db import normalize_column, normalize_string
+
+ALPHABET = 'abcxyzAZß0123456789۱۲۳۴۵۶۷۸۹۰١٢٣٤٥٦٧٨٩٠ -_/.#ﬁİ５१'
+
+
+def random_serials(count, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 14))) for _ in range(count)]
+
+
+def test_normalize_column_matches_normalize_string():
+    serials = random_serials(3000) + ['٥۲٥ ٥۱x', 'aa-0012', 'FA1234567', '']
+    assert list(normalize_column(Series(serials, dtype=object))) == [normalize_string(s) for s in serials]
+
+
+def test_normalize_column_of_a_string_dtype_column():
+    serials = random_serials(500, seed=1)
+    assert list(normalize_column(Series(serials).astype('str'))) == [normalize_string(s) for s in serials]
+
+
+def test_normalize_column_leaves_out_cells_which_are_not_text():
+    normalized = normalize_column(Series(['ab12', 12, None, 2.5], dtype=object))
+    assert list(normalized) == [normalize_string('ab12'), None, None, None]
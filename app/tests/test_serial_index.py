@@ -0,0 +1,73 @@
+import datetime
+import random
+
+from serial_index import Snapshot
+
+
+def serial(prefix, number):
+    return prefix + str(number).rjust(30 - len(prefix), '0')
+
+
+def sql_lookup(rows, invalids, wanted):
+    """ what the old check_serial got from
+    SELECT * FROM serials WHERE start_serial <= %s and end_serial >= %s """
+    if wanted in invalids:
+        return 'FAILURE', None
+    matches = [row for row in rows if row[3] <= wanted <= row[4]]
+    if len(matches) > 1:
+        return 'DOUBLE', None
+    elif len(matches) == 1:
+        return 'OK', matches[0]
+    return 'NOT-FOUND', None
+
+
+def random_catalog(seed, count=300, width=30):
+    rng = random.Random(seed)
+    rows = [(1, 'r', 'd', serial('AA', 1), serial('AA', 100), datetime.datetime(2020, 1, 1), 't1', 't2'),
+            (2, 'r', 'd', serial('AA', 5), serial('AA', 6), datetime.datetime(2020, 1, 1), 't1', 't2'),
+            (3, 'r', 'd', serial('AA', 7), serial('AA', 8), datetime.datetime(2020, 1, 1), 't1', 't2')]
+    for id_row in range(4, count):
+        prefix = rng.choice(['AA', 'AB', 'B', ''])
+        start = rng.randint(0, 5000)
+        end_prefix = 'AC' if id_row % 50 == 7 else prefix  # start and end letters differ
+        rows.append((id_row, 'r', 'd', serial(prefix, start), serial(end_prefix, start + rng.randint(0, width)),
+                     datetime.datetime(2020, 1, 1), 't1', 't2'))
+    invalids = {serial(rng.choice(['AA', 'AB']), rng.randint(0, 5000)) for _ in range(50)}
+    wanted = [serial(rng.choice(['AA', 'AB', 'AC', 'B', '', 'Z']), rng.randint(0, 5100)) for _ in range(3000)]
+    return rows, invalids, wanted + sorted(invalids)[:5]
+
+
+def test_snapshot_answers_like_the_sql_query():
+    for seed, width in ((0, 30), (1, 0), (2, 400)):
+        rows, invalids, wanted = random_catalog(seed, width=width)
+        snapshot = Snapshot(rows, invalids)
+        for serial_number in wanted:
+            assert snapshot.lookup(serial_number) == sql_lookup(rows, invalids, serial_number), serial_number
+
+
+def test_snapshot_finds_a_double_behind_nested_ranges():
+    rows, invalids, _ = random_catalog(0, count=4)
+    assert Snapshot(rows, set()).lookup(serial('AA', 50)) == ('OK', rows[0])
+    assert Snapshot(rows, set()).lookup(serial('AA', 5))[0] == 'DOUBLE'
+
+
+def test_snapshot_under_a_covering_range():
+    rng = random.Random(3)
+    rows = [(0, 'r', 'd', serial('AA', 0), serial('AA', 10 ** 6), None, '', '')]
+    for id_row in range(1, 500):
+        start = rng.randint(0, 10 ** 6)
+        rows.append((id_row, 'r', 'd', serial('AA', start), serial('AA', start + rng.randint(0, 3)), None, '', ''))
+    rows.append((500, 'r', 'd', serial('AA', 9), serial('AA', 3), None, '', ''))  # start after end
+    snapshot = Snapshot(rows, set())
+    wanted = [serial('AA', row_number) for row_number in range(0, 10 ** 6 + 10, 997)]
+    wanted += [row[3] for row in rows] + [row[4] for row in rows]
+    for serial_number in wanted:
+        assert snapshot.lookup(serial_number) == sql_lookup(rows, set(), serial_number), serial_number
+
+
+def test_snapshot_skips_rows_without_serials():
+    rows = [(1, 'r', 'd', None, serial('AA', 9), None, '', ''),
+            (2, 'r', 'd', serial('AA', 1), serial('AA', 9), None, '', '')]
+    snapshot = Snapshot(rows, [])
+    assert snapshot.size == 1
+    assert snapshot.lookup(serial('AA', 3)) == ('OK', rows[1])
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from sms_dispatcher import FAILED, RETRY, SENT, SmsDispatcher
+
+
+class FlakyTransport:
+    """ the first batch gets a server error, later ones are sent; 'bad' receptors always fail """
+
+    def __init__(self):
+        self.calls = 0
+
+    def send_batch(self, items):
+        self.calls += 1
+        return [(FAILED, '411 invalid receptor') if receptor == 'bad' else
+                (RETRY, '502 bad gateway') if self.calls == 1 else (SENT, '1234 sent')
+                for receptor, _ in items]
+
+
+class FakeDb:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return self
+
+    def executemany(self, query, rows):
+        self.rows.extend(rows)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_final_statuses_are_stored_and_counted():
+    stored = []
+    dispatcher = SmsDispatcher(FlakyTransport(), batch_window=0.05, backoff=0.01,
+                               get_connection=lambda: FakeDb(stored))
+    senders = [threading.Thread(target=lambda: [dispatcher.send(f'0912{i}', 'hi') for i in range(200)])
+               for _ in range(4)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    dispatcher.send('bad', 'hi')
+    deadline = time.monotonic() + 10
+    while len(stored) < 801 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dispatcher.stop()
+
+    counters = dispatcher.stats()['counters']
+    assert counters['queued'] == 801
+    assert counters['sent'] + counters['failed'] == counters['stored'] == len(stored) == 801
+    assert sorted(status for receptor, status, *_ in stored if receptor == 'bad') == ['FAILED']
+    assert {status for receptor, status, *_ in stored if receptor != 'bad'} == {'SENT'}
+
+
+def test_retries_left_at_stop_are_recorded_as_failed():
+    stored = []
+    dispatcher = SmsDispatcher(FlakyTransport(), batch_window=0.01, backoff=60,
+                               get_connection=lambda: FakeDb(stored))
+    dispatcher.send('09120', 'hi')
+    deadline = time.monotonic() + 10
+    while not dispatcher.stats()['retry_queue'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dispatcher.stop()
+    assert [row[:3] for row in stored] == [('09120', 'FAILED', 'not retried, the app stopped')]
+    assert dispatcher.stats()['counters']['failed'] == 1
@@ -0,0 +1,49 @@
+import time
+
+from throttle import WebhookThrottle
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def flood(throttle, sender, count, handled):
+    """ sends `count` messages like the webhook does; returns what happened to them """
+    outcomes = []
+    for number in range(count):
+        decision = throttle.check(sender)
+        if decision is None:
+            handled.append((sender, number))
+            outcomes.append('processed')
+        elif decision[0] == 'queue' and throttle.postpone(sender, number, lambda s, m: handled.append((s, m)),
+                                                          decision[2]):
+            outcomes.append('queued')
+        else:
+            outcomes.append(decision[0])
+    return outcomes
+
+
+def test_a_sender_over_both_limits_gets_only_its_own_limit_through():
+    throttle = WebhookThrottle([('sender', '5 per minute', 'drop'), ('global', '2 per 1 second', 'queue')],
+                               retry_interval=0.05)
+    handled = []
+    outcomes = flood(throttle, 'flooder', 30, handled)
+    assert outcomes.count('processed') + outcomes.count('queued') == 5
+    assert outcomes.count('drop') == 25
+    wait_for(lambda: len(handled) == 5)
+    time.sleep(0.3)
+    assert len(handled) == 5
+    assert throttle.stats()['queue'] == 0
+
+
+def test_a_blocked_sender_does_not_hold_up_the_queue():
+    throttle = WebhookThrottle([('sender', '1 per minute', 'queue'), ('global', '1 per 1 second', 'queue')],
+                               retry_interval=0.05)
+    handled = []
+    assert flood(throttle, 'flooder', 2, handled) == ['processed', 'queued']
+    assert flood(throttle, 'fresh', 1, handled) == ['queued']
+    wait_for(lambda: ('fresh', 0) in handled)
+    assert ('fresh', 0) in handled
+    assert ('flooder', 1) not in handled
@@ -0,0 +1,144 @@
+import collections
+import threading
+import time
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+SCOPES = ('sender', 'global')
+ACTIONS = ('drop', 'reply_once', 'queue')
+
+
+class WebhookThrottle:
+    """ rate policies for the sms webhook. a policy is (scope, limit, action):
+      scope   'sender' counts every phone number on its own, 'global' counts all of them
+      limit   a limits string like '5 per minute'
+      action  what happens to a message over the limit:
+              'drop'        it is ignored
+              'reply_once'  the sender gets one notice per window, the rest is ignored
+              'queue'       it is processed later, when this policy allows it again;
+                            it counts against the other policies when it is queued
+    the counters live in a limits storage (memory://, redis://, memcached://) so
+    all workers can share them. the queue of postponed messages is per process """
+
+    def __init__(self, policies, storage_uri='memory://', max_queue=1000, retry_interval=1):
+        self.policies = []
+        for scope, limit, action in policies:
+            if scope not in SCOPES or action not in ACTIONS:
+                raise ValueError(f'bad webhook policy {(scope, limit, action)}')
+            item = parse(limit)
+            notice = parse(f'1 per {item.get_expiry()} second')
+            self.policies.append((scope, item, action, notice))
+        self._limiter = FixedWindowRateLimiter(storage_from_string(storage_uri))
+        self.max_queue = max_queue
+        self.retry_interval = retry_interval
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._handler = None
+        self.counters = collections.Counter()
+
+    def _identifiers(self, number, scope, sender):
+        return ('webhook', str(number), sender if scope == 'sender' else 'all')
+
+    def _blocking(self, sender, numbers=None):
+        """ the numbers of the policies (of `numbers`, or all) this sender is over """
+        blocking = []
+        for number, (scope, item, _, _) in enumerate(self.policies):
+            if numbers is not None and number not in numbers:
+                continue
+            if not self._limiter.test(item, *self._identifiers(number, scope, sender)):
+                blocking.append(number)
+        return blocking
+
+    def _hit(self, sender, numbers):
+        for number in numbers:
+            scope, item, _, _ = self.policies[number]
+            self._limiter.hit(item, *self._identifiers(number, scope, sender))
+
+    def check(self, sender):
+        """ returns None if the message can be processed now (and counts it), or
+        (action, notify, waiting) where notify tells a reply_once policy to send its
+        notice. a message over a 'drop' or 'reply_once' policy gets that policy's
+        action and nothing is counted for it. a message over 'queue' policies only
+        gets 'queue' and `waiting`, the numbers of those policies; it is counted
+        against all the other policies right away, so a sender can not queue more
+        than its own limits let through """
+        if not self.policies:
+            return None
+        blocking = self._blocking(sender)
+        if not blocking:
+            self._hit(sender, range(len(self.policies)))
+            return None
+        for number in blocking:
+            scope, _, action, notice = self.policies[number]
+            if action != 'queue':
+                self.counters[f'{action}:{scope}'] += 1
+                notify = action == 'reply_once' and self._limiter.hit(
+                    notice, 'webhook-notice', *self._identifiers(number, scope, sender)[1:])
+                return action, notify, ()
+        for number in blocking:
+            self.counters[f'queue:{self.policies[number][0]}'] += 1
+        self._hit(sender, [number for number in range(len(self.policies)) if number not in blocking])
+        return 'queue', False, tuple(blocking)
+
+    def postpone(self, sender, message, handler, waiting):
+        """ keeps the message until the `waiting` policies, the ones that queued it,
+        let it through; handler(sender, message) is then called from a background
+        thread. returns False if the queue is full """
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.counters['queue_full'] += 1
+                return False
+            self._handler = handler
+            self._queue.append((sender, message, tuple(waiting)))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='webhook-queue', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return True
+
+    def _ready(self, queued):
+        """ the first queued message whose waiting policies all let it through now,
+        or None. the other policies counted it when it was queued, and a sender over
+        its own limit does not hold up the messages queued behind it """
+        blocked = set()
+        for entry in queued:
+            sender, _, waiting = entry
+            identifiers = tuple(self._identifiers(number, self.policies[number][0], sender) for number in waiting)
+            if identifiers in blocked:
+                continue
+            if not self._blocking(sender, waiting):
+                return entry
+            blocked.add(identifiers)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                queued = list(self._queue)
+            try:
+                entry = self._ready(queued)
+                if entry is None:
+                    time.sleep(self.retry_interval)
+                    continue
+                sender, message, waiting = entry
+                self._hit(sender, waiting)
+            except Exception:
+                time.sleep(self.retry_interval)  # the shared storage is down; wait
+                continue
+            with self._cond:
+                self._queue.remove(entry)
+            try:
+                self._handler(sender, message)
+                self.counters['dequeued'] += 1
+            except Exception:
+                self.counters['dequeue_errors'] += 1
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._queue)
+        return {'queue': queued, 'counters': dict(self.counters)}